@@ -0,0 +1,92 @@
+import re
+import time
+from typing import Optional
+
+import numpy as np
+
+#### Semantic cache of fact-checked answers, keyed on the query embedding ####
+
+def words(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+def specific_words(text: str) -> set[str]:
+    """Names and numbers, e.g. "Jane", "Boulder" or a zip code: capitalized words that don't start
+    a sentence, and words with digits"""
+    specific = set()
+    for sentence in re.split(r"(?<=[.!?])\s+", text):
+        tokens = re.findall(r"\w+", sentence)
+        specific |= {token.lower() for i, token in enumerate(tokens) if (i and token[0].isupper()) or re.search(r"\d", token)}
+    return specific
+
+def personal_words(answer: str, user_messages: list[str], shared: str) -> set[str]:
+    """Words in the answer that come from the conversation rather than from the shared text (the
+    context) it was generated from: anything from the user's earlier messages, and names and numbers
+    from the current one. An answer with any is not safe to give other users."""
+    *earlier, current = user_messages
+    sensitive = words(" ".join(earlier)) | specific_words(current)
+    allowed = words(shared) | (words(current) - specific_words(current))
+    return (words(answer) & sensitive) - allowed
+
+class SemanticAnswerCache:
+    """Stores answers that passed the fact checker so near-duplicate questions can be answered
+    without another LLM call. A cached answer is returned when the cosine similarity between the
+    new query and a cached query is at least `threshold` and the entry is younger than `ttl` seconds."""
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 24*60*60, max_items: int = 500):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_items = max_items
+
+        self.vectors = []
+        self.entries = []  # (answer, sources, created_at), aligned with self.vectors
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "size": len(self.entries)}
+
+    def expire(self, max_age: Optional[float] = None):
+        """Drop entries older than max_age seconds (defaults to the ttl)"""
+        max_age = self.ttl if max_age is None else max_age
+        now = time.time()
+        keep = [i for i, (_, _, created_at) in enumerate(self.entries) if now - created_at < max_age]
+        self.vectors = [self.vectors[i] for i in keep]
+        self.entries = [self.entries[i] for i in keep]
+
+    def clear(self):
+        """Forget everything, e.g. after the document collections are re-loaded"""
+        self.vectors = []
+        self.entries = []
+
+    def lookup(self, query_vector: list[float]) -> Optional[tuple[str, str]]:
+        """Return (answer, sources) for the most similar fresh cached query, or None"""
+        self.expire()
+        if self.vectors:
+            similarities = np.array(self.vectors) @ self.normalize(query_vector)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                self.hits += 1
+                answer, sources, _ = self.entries[best]
+                print(f"answer cache hit (similarity {similarities[best]:.3f}), stats: {self.stats()}")
+                return answer, sources
+        self.misses += 1
+        return None
+
+    def add(self, query_vector: list[float], answer: str, sources: str):
+        if len(self.entries) >= self.max_items:
+            # Oldest entries are at the front
+            self.vectors.pop(0)
+            self.entries.pop(0)
+        self.vectors.append(self.normalize(query_vector))
+        self.entries.append((answer, sources, time.time()))
+
+    @staticmethod
+    def normalize(vector: list[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
@@ -1,65 +1,96 @@
 import os
-import csv
-from datetime import datetime
+import hmac
+import time
 from dotenv import load_dotenv
 
 import chainlit as cl
+from chainlit.server import app as chainlit_server
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
 import asyncio
+import weakref
+from operator import itemgetter
 from uuid import uuid4
 
-from langchain_qdrant import QdrantVectorStore
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from langchain_anthropic import ChatAnthropic
 from langchain_openai import OpenAIEmbeddings
-from langchain.retrievers import EnsembleRetriever
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.memory import ConversationBufferWindowMemory
-from langchain.chains import create_history_aware_retriever
 from langchain_core.prompts import MessagesPlaceholder
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda, RunnableBranch, RunnablePassthrough
 
-from vars import SYSTEM_PROMPT, MAX_CONTEXT, GREETING, PASSWORD_FILE
+from vars import GREETING, PASSWORD_FILE, PASSWORD_DB, SESSION_STORE_URL, SESSION_TTL
+from vars import FACT_CHECK_BATCH_SIZE, FACT_CHECK_SKIP_THRESHOLD, FACT_CHECKER_GIVE_UP_MESSAGE
+from vars import LATENCY_SLO, DEGRADE_SKIP_FACT_CHECK, METRICS_ENABLED, STREAM_FLUSH_INTERVAL, STREAM_FLUSH_CHARS
 from vars import COLLECTION_NAME_FIXED, COLLECTION_NAME_SEMANTIC, URL
-from vars import HAIKU, SONNET, TEMPERATURE, TOP_P, MAX_TOKENS, MAX_MEMORY
-from utils import add_sources, get_toolbelt, use_eldercare_api, check_facts, retry_stream
+from vars import CONTEXT_TOKEN_BUDGET, CONTEXT_MMR_LAMBDA, CONTEXT_DUPLICATE_THRESHOLD, CONTEXT_MMR_VECTORS
+from vars import LEXICAL_INDEX_FILE, EMBEDDING_TIMEOUT
+from vars import HAIKU, SONNET, TEMPERATURE, TOP_P, MAX_TOKENS
+from vars import REWRITER_TOKEN_BUDGET, ROUTER_TOKEN_BUDGET, ANSWER_HISTORY_TOKEN_BUDGET, ANSWER_HISTORY_STEP
+from vars import PROMPT_CACHING, PROMPT_CACHING_HEADERS
+from vars import ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_SIZE, ANSWER_CACHE_MAX_HISTORY
+from vars import VECTOR_STORAGE, EMBEDDING_MODEL, EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MEMORY_SIZE, EMBEDDING_CACHE_DISK_SIZE
+from retriever import FusedQdrantRetriever
+from packing import pack_context
+from lexical import BM25Index
+from vector_storage import storage_embeddings, search_params
+from embedding_cache import CachedEmbeddings
+from answer_cache import SemanticAnswerCache, personal_words
+from memory import SummarizedMemory
+from prompts import answer_messages
+from auth import CredentialStore
+from session_store import get_session_store
+from scheduler import get_scheduler
+from streaming import CoalescedStream
+from metrics import span, timed, observe, ttft_seconds, turn_seconds, render_metrics, record_answer_cache_lookup
+from utils import add_sources, get_toolbelt, get_eldercare_client, use_eldercare_api, StreamingFactChecker
 
 # Environment vars
 load_dotenv('.env')
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-try:
-    LANGCHAIN_API_KEY = os.getenv("LANGCHAIN_API_KEY")
-except:
-    print(f"Langsmith API key not found; tracing will not be enabled")
+LANGCHAIN_API_KEY = os.getenv("LANGCHAIN_API_KEY")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
+# Tracing is only on when there's a Langsmith key, and LANGCHAIN_TRACING_V2=false turns it off
+if LANGCHAIN_API_KEY:
+    os.environ.setdefault("LANGCHAIN_TRACING_V2", "true")
+else:
+    print(f"Langsmith API key not found; tracing will not be enabled")
 unique_id = uuid4().hex[0:8]
 os.environ["LANGCHAIN_PROJECT"] = f"CareCompanion - {unique_id}"
 
 if not ANTHROPIC_API_KEY or not OPENAI_API_KEY:
     raise ValueError("ANTHROPIC_API_KEY or OPENAI_API_KEY environment variable is not set")
 
-# Embedding model
-openai_embeddings = OpenAIEmbeddings(
-    model="text-embedding-3-large",
-    openai_api_key=OPENAI_API_KEY  
+# Embedding model, with a cache in front of it since caregivers often ask the same questions
+openai_embeddings = CachedEmbeddings(
+    OpenAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        openai_api_key=OPENAI_API_KEY  
+    ),
+    model=EMBEDDING_MODEL,
+    path=EMBEDDING_CACHE_FILE,
+    max_memory_items=EMBEDDING_CACHE_MEMORY_SIZE,
+    max_disk_items=EMBEDDING_CACHE_DISK_SIZE
 )
 
 # Initialize retriever
 def init_retriever(llm):
 
-    fixed_store = QdrantVectorStore.from_existing_collection (
-        embedding=openai_embeddings,
-        collection_name=COLLECTION_NAME_FIXED,
-        url=URL
+    # One query embedding and one concurrent search of both collections per turn, fused with BM25 results
+    fused_retriever = FusedQdrantRetriever(
+        client=qdrant_client,
+        async_client=async_qdrant_client,
+        embeddings=storage_embeddings(openai_embeddings, VECTOR_STORAGE),
+        collection_names=[COLLECTION_NAME_FIXED, COLLECTION_NAME_SEMANTIC],
+        k=10,
+        search_params=search_params(VECTOR_STORAGE),
+        with_vectors=CONTEXT_MMR_VECTORS,
+        lexical_index=lexical_index,
+        embedding_timeout=EMBEDDING_TIMEOUT
     )
-    semantic_store = QdrantVectorStore.from_existing_collection (
-        embedding=openai_embeddings,
-        collection_name=COLLECTION_NAME_SEMANTIC,
-        url=URL
-    )
-    similarity_retriever_fixed = fixed_store.as_retriever(k=10)
-    similarity_retriever_semantic = semantic_store.as_retriever(k=10)
-    ensemble_retriever = EnsembleRetriever(retrievers=[similarity_retriever_fixed, 
-                                                       similarity_retriever_semantic])
     
     # Prompt for context-awareness
     retriever_prompt = ChatPromptTemplate.from_messages([
@@ -67,57 +98,141 @@ def init_retriever(llm):
         ("user", "User input: {input}"),
         ("user", "Given the above conversation, generate a search query to look up to get information relevant to the the user's input")
     ])
-    retriever_chain = create_history_aware_retriever(llm, ensemble_retriever, retriever_prompt)
+    # The query rewrite is timed on its own, so it can be told apart from the search itself
+    async def rewrite_query(prompt):
+        with span("query_rewrite"):
+            return await get_scheduler(llm).invoke(llm, prompt)
+    rewriter = RunnableLambda(llm.invoke, afunc=rewrite_query)
+    # Like create_history_aware_retriever, but the standalone query is returned along with the
+    # documents as {"query": ..., "docs": ...}, since the answer cache is keyed on it
+    rewrite_chain = RunnableBranch(
+        (lambda inputs: not inputs.get("chat_history"), itemgetter("input")),
+        retriever_prompt | rewriter | StrOutputParser()
+    )
+    retriever_chain = RunnablePassthrough.assign(query=rewrite_chain) | RunnablePassthrough.assign(docs=itemgetter("query") | fused_retriever)
 
     print(f"Initialized retriever of type {type(retriever_chain)}")
     return retriever_chain
 
-@cl.on_chat_start
-async def start():    
-
-    haiku_llm = ChatAnthropic(
-        model=HAIKU,    
-        anthropic_api_key=ANTHROPIC_API_KEY,
-        temperature = TEMPERATURE,
-        top_p = TOP_P,
-        max_tokens = MAX_TOKENS
-    )
-    sonnet_llm = ChatAnthropic(
-        model= SONNET,
-        anthropic_api_key=ANTHROPIC_API_KEY,
-        temperature = TEMPERATURE,
-        top_p = TOP_P,
-        max_tokens = MAX_TOKENS
-    )
-    llm_with_tools = haiku_llm.bind_tools(get_toolbelt())
-
-    fact_checker_llm = ChatAnthropic(
-        model=SONNET, # Haiku is unable to reliably accomplish this. Good use case for fine tuning a small llm?
-        anthropic_api_key=ANTHROPIC_API_KEY,
-        temperature = TEMPERATURE,
-        top_p = TOP_P,
-        max_tokens = 1 # Ensure output is just Y or N
-    )
-
-    fact_fixer_llm = sonnet_llm
+# Shared clients. These are created once per process and re-used by every chat session, 
+# so that HTTP connection pools stay warm and session start doesn't need any network calls.
+# Conversation memory is kept in the session store, so it can be shared by worker processes.
+qdrant_client = QdrantClient(url=URL)
+async_qdrant_client = AsyncQdrantClient(url=URL)
+
+anthropic_headers = PROMPT_CACHING_HEADERS if PROMPT_CACHING else None
+haiku_llm = ChatAnthropic(
+    model=HAIKU,    
+    anthropic_api_key=ANTHROPIC_API_KEY,
+    temperature = TEMPERATURE,
+    top_p = TOP_P,
+    max_tokens = MAX_TOKENS,
+    default_headers = anthropic_headers
+)
+sonnet_llm = ChatAnthropic(
+    model= SONNET,
+    anthropic_api_key=ANTHROPIC_API_KEY,
+    temperature = TEMPERATURE,
+    top_p = TOP_P,
+    max_tokens = MAX_TOKENS,
+    default_headers = anthropic_headers
+)
+llm_with_tools = haiku_llm.bind_tools(get_toolbelt())
+
+fact_checker_llm = ChatAnthropic(
+    model=SONNET, # Haiku is unable to reliably accomplish this. Good use case for fine tuning a small llm?
+    anthropic_api_key=ANTHROPIC_API_KEY,
+    temperature = TEMPERATURE,
+    top_p = TOP_P,
+    max_tokens = 1, # Ensure output is just Y or N
+    default_headers = anthropic_headers
+)
 
-    memory = ConversationBufferWindowMemory(k=MAX_MEMORY)
+llm = sonnet_llm # Change this line to swap out the main question answering LLM!!
+fact_fixer_llm = sonnet_llm
 
-    retriever = None
+# Exact-term search over the same chunks, which also keeps retrieval working if embeddings are slow
+lexical_index = None
+if os.path.exists(LEXICAL_INDEX_FILE):
     try:
-        retriever = init_retriever(haiku_llm)
+        lexical_index = BM25Index.load(LEXICAL_INDEX_FILE)
     except Exception as e:
-        print(f"error initializing retriever: {e}")
-    if not retriever: raise ValueError("Error initializing retriever")
+        print(f"error loading lexical index: {e}")
+else:
+    print(f"Lexical index {LEXICAL_INDEX_FILE} not found; retrieval will be dense only")
+
+retriever = None
+try:
+    retriever = init_retriever(haiku_llm)
+except Exception as e:
+    print(f"error initializing retriever: {e}")
+
+credential_store = CredentialStore(PASSWORD_DB, csv_path=PASSWORD_FILE)
+session_store = get_session_store(SESSION_STORE_URL, ttl=SESSION_TTL)
+
+# Keep references to fire-and-forget tasks so they aren't garbage collected before finishing
+background_tasks = set()
+
+answer_cache = None
+if ANSWER_CACHE_ENABLED:
+    answer_cache = SemanticAnswerCache(threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL,
+                                       max_items=ANSWER_CACHE_SIZE)
+
+def get_session_id() -> str:
+    # The thread id identifies the conversation across reconnects and worker processes
+    return cl.context.session.thread_id
+
+# Each turn loads its own memory object, so the lock that keeps a session's background summary
+# updates from overlapping is kept here, by session id. A lock is dropped once no task holds it.
+summary_locks = weakref.WeakValueDictionary()
+
+# The summary has to keep up with the consumer that gets the least history
+HISTORY_TOKEN_BUDGET = min(REWRITER_TOKEN_BUDGET, ROUTER_TOKEN_BUDGET, ANSWER_HISTORY_TOKEN_BUDGET)
+
+async def update_summary(memory: SummarizedMemory, session_id: str):
+    lock = summary_locks.setdefault(session_id, asyncio.Lock())
+    async with lock:
+        # Pick up the summary written by an earlier turn's update while this one was waiting
+        memory.load_summary(await session_store.get(session_id))
+        if await memory.update_summary(haiku_llm):
+            # Only the summary fields are written, so messages saved by a newer turn are kept
+            await session_store.update(session_id, memory.summary_state())
+
+# Prometheus scrape endpoint on Chainlit's own web server. Metrics are per worker process.
+# The server is public, so scrapes must send "Authorization: Bearer <METRICS_TOKEN>"
+async def metrics_endpoint(request: Request):
+    authorization = request.headers.get("authorization", "").encode("utf-8")
+    if not hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}".encode("utf-8")):
+        return PlainTextResponse("Unauthorized\n", status_code=401)
+    return PlainTextResponse(render_metrics())
+
+if METRICS_ENABLED and not METRICS_TOKEN:
+    print("METRICS_TOKEN not set; /metrics will not be served")
+elif METRICS_ENABLED:
+    chainlit_server.add_api_route("/metrics", metrics_endpoint, methods=["GET"])
+    # Chainlit serves its frontend from a catch-all route, so ours has to be matched first
+    chainlit_server.router.routes.insert(0, chainlit_server.router.routes.pop())
+
+@cl.on_chat_start
+async def start():    
+
+    # Session start only sets up this session's memory, since the clients are shared
+    with span("session_start"):
+        # If Qdrant wasn't reachable when the app started, try again now
+        global retriever
+        if not retriever:
+            try:
+                retriever = init_retriever(haiku_llm)
+            except Exception as e:
+                print(f"error initializing retriever: {e}")
+        if not retriever: raise ValueError("Error initializing retriever")
 
-    memory.chat_memory.add_ai_message(GREETING)
+        # Start loading the Eldercare WSDL in the background so the first tool call doesn't wait on it
+        get_eldercare_client().warm_up()
 
-    cl.user_session.set("retriever",retriever)
-    cl.user_session.set("llm",sonnet_llm) # Change this line to swap out the main question answering LLM!!
-    cl.user_session.set("llm_with_tools",llm_with_tools)
-    cl.user_session.set("fact_checker_llm",fact_checker_llm)
-    cl.user_session.set("fact_fixer_llm",fact_fixer_llm)
-    cl.user_session.set("memory",memory)
+        memory = SummarizedMemory(budget=HISTORY_TOKEN_BUDGET)
+        memory.add_ai_message(GREETING)
+        await session_store.update(get_session_id(), memory.messages_state())
 
     msg = cl.Message(content=GREETING)
     await msg.send()
@@ -126,30 +241,14 @@ async def start():
 @cl.password_auth_callback
 def auth_callback(username: str, password: str):
 
-    found_user = False
-    found_password = False
-
     try:
-        with open(PASSWORD_FILE, mode="r") as csvfile:
-            reader = csv.DictReader(csvfile)
-
-            for row in reader:
-                if row["username"] == username:
-                    found_user = True
-                    if password == row["password"]:
-                        found_password = True 
+        authenticated = credential_store.authenticate(username, password)
     except Exception as e:
         print(f"authentication failed with error {e}")
         raise
-    
-    # if the username is not found, create a new one
-    with open(PASSWORD_FILE, mode="a", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            created_at = datetime.now().isoformat()
-            writer.writerow([username, password, created_at])
-
-    # if the username and password are found in the db, proceed
-    if (found_user and found_password) or (not found_user):
+
+    # New usernames are registered on first login; existing ones need the right password
+    if authenticated:
         return cl.User(
             identifier=username, metadata={"role": "user", "provider": "credentials"}
         )
@@ -165,28 +264,47 @@ def rename(orig_author: str):
 @cl.on_message
 async def main(message: cl.Message):
 
-    retriever = cl.user_session.get("retriever")
-    llm = cl.user_session.get("llm")
-    llm_with_tools = cl.user_session.get("llm_with_tools")
-    fact_checker_llm = cl.user_session.get("fact_checker_llm")
-    fact_fixer_llm = cl.user_session.get("fact_fixer_llm")
-    
-    memory = cl.user_session.get("memory")
-    memory.chat_memory.add_user_message(message.content)
+    turn_start = time.perf_counter()
+
+    # Conversation state lives in the shared session store so that any worker can serve this turn
+    session_id = get_session_id()
+    # If the last turn's summary update is still running, wait for it, or the messages it is folding
+    # in would be in neither the summary nor the history
+    lock = summary_locks.get(session_id)
+    if lock is not None and lock.locked():
+        with span("summary_wait"):
+            async with lock:
+                pass
+    memory = SummarizedMemory.from_state(await session_store.get(session_id), budget=HISTORY_TOKEN_BUDGET)
+    memory.add_user_message(message.content)
 
     msg = cl.Message(content="")
+    stream = CoalescedStream(msg, interval=STREAM_FLUSH_INTERVAL, max_chars=STREAM_FLUSH_CHARS)
+
+    # Near-duplicate questions can be answered from the cache, as long as the answer doesn't depend
+    # on Eldercare API results. The cache is shared by every user, so it is keyed on the standalone
+    # query from the rewriter, and answers that may be cached are generated from that query without
+    # the conversation history
+    user_turns = len([m for m in memory.messages if m.type == "human"])
+    use_answer_cache = answer_cache is not None and user_turns <= ANSWER_CACHE_MAX_HISTORY
+    standalone_query = message.content
+    query_vector = None
 
     context_docs = None
+    tool_output = ""
     try:
         retriever_inputs = {
             "input": message.content,
-            "chat_history": memory.chat_memory.messages
+            "chat_history": memory.messages_for(REWRITER_TOKEN_BUDGET)
         }
-        retriever_task = retriever.ainvoke(retriever_inputs)
-        tool_output_task = use_eldercare_api(memory.chat_memory.messages, llm_with_tools)
-        context_docs, tool_output = await asyncio.gather(retriever_task, tool_output_task)
-
-        context_docs = context_docs[:MAX_CONTEXT]  # Limit context size if necessary
+        retriever_task = timed("retrieval", retriever.ainvoke(retriever_inputs))
+        tool_output_task = timed("eldercare_tool", use_eldercare_api(memory.messages_for(ROUTER_TOKEN_BUDGET), llm_with_tools))
+        retrieved, tool_output = await asyncio.gather(retriever_task, tool_output_task)
+        context_docs, standalone_query = retrieved["docs"], retrieved["query"]
+
+        with span("context_packing"):
+            context_docs = pack_context(context_docs, token_budget=CONTEXT_TOKEN_BUDGET, lambda_mult=CONTEXT_MMR_LAMBDA,
+                                        duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD)
         sources = add_sources(context_docs)
         formatted_context = "\n".join([doc.page_content for doc in context_docs])
         #print(f"formatted context: {formatted_context}") #uncomment to see context
@@ -195,43 +313,99 @@ async def main(message: cl.Message):
         print(f"Error in retrieval or tool use: {e}")
         #await cl.Message(content="I'm sorry, an error occurred processing your request").send()
 
+    if use_answer_cache and context_docs and not tool_output:
+        try:
+            # The retriever has just embedded the same query, so this is served by the embedding cache
+            with span("answer_cache_embedding"):
+                query_vector = await openai_embeddings.aembed_query(standalone_query)
+        except Exception as e:
+            print(f"Error embedding the query for the answer cache: {e}")
+
+    if query_vector is not None:
+        with span("answer_cache_lookup"):
+            cached = answer_cache.lookup(query_vector)
+        record_answer_cache_lookup(cached is not None, answer_cache.hit_rate)
+        if cached:
+            ai_response, sources = cached
+            observe(ttft_seconds, time.perf_counter() - turn_start, source="answer_cache")
+            await stream.write(ai_response)
+            await stream.write(sources)
+            await stream.close()
+            await msg.send()
+            memory.add_ai_message(ai_response)
+            await session_store.update(session_id, memory.messages_state())
+            observe(turn_seconds, time.perf_counter() - turn_start, source="answer_cache")
+            return
+
     ai_response = ""
-    fact_checker_passed = False
-    attempt = 1
-    max_tries = 3
 
     if context_docs:
         try:
             prompt_inputs = {
                 'context': formatted_context,
-                'history': memory.load_memory_variables({})["history"],
+                'history': memory.history_lines(ANSWER_HISTORY_TOKEN_BUDGET, ANSWER_HISTORY_STEP),
                 'tool_output': tool_output,
                 'query': message.content
             }
-
-            prompt_text = SYSTEM_PROMPT.format(**prompt_inputs)
-
-            async for chunk in retry_stream(llm,prompt_text):
-                #print(chunk) #uncomment to debug streaming
-                ai_response+=chunk.content
-                await msg.stream_token(chunk.content)
-
-            await msg.stream_token(sources)
+            if query_vector is not None:
+                # An answer that may be shared with other users can't use anything from this conversation
+                prompt_inputs['history'] = [""]
+                prompt_inputs['query'] = standalone_query
+
+            prompt_messages = answer_messages(**prompt_inputs)
+
+            # If Sonnet calls are queueing for longer than the SLO, answer with Haiku instead
+            # and (optionally) skip the fact check, rather than make the overload worse
+            answer_llm = llm
+            check_facts = True
+            if get_scheduler(llm).overloaded(LATENCY_SLO):
+                print(f"{get_scheduler(llm).name} is overloaded, degrading to {HAIKU}")
+                answer_llm = haiku_llm
+                check_facts = not DEGRADE_SKIP_FACT_CHECK
+
+            # Sentences are fact checked while the rest of the answer is still being generated
+            fact_checker = StreamingFactChecker(formatted_context, tool_output, "".join(prompt_inputs['history']).rstrip("\n"),
+                                                fact_checker_llm, fact_fixer_llm, batch_size=FACT_CHECK_BATCH_SIZE,
+                                                skip_threshold=FACT_CHECK_SKIP_THRESHOLD, enabled=check_facts)
+            with span("generation"):
+                async for text in fact_checker.stream(answer_llm, prompt_messages):
+                    if not ai_response:
+                        observe(ttft_seconds, time.perf_counter() - turn_start, source=answer_llm.model)
+                    ai_response+=text
+                    await stream.write(text)
+
+            if not ai_response.strip():
+                # Nothing in the answer could be supported by the context
+                ai_response = FACT_CHECKER_GIVE_UP_MESSAGE
+                await stream.write(ai_response)
+            else:
+                await stream.write(sources)
+            await stream.close()
             await msg.send()
 
-            while not fact_checker_passed and attempt<=max_tries:
-
-                fact_checker_passed = await check_facts(formatted_context, tool_output, ai_response,
-                                                        fact_checker_llm, memory, fact_fixer_llm,
-                                                        attempt, max_tries)
-                attempt += 1
+            # Only cache answers that passed the fact checker without any fixes, or any batches it failed
+            # to check, and that repeat nothing the user said that isn't in the context
+            if (query_vector is not None and fact_checker.enabled and fact_checker.fixed == 0 and fact_checker.failed == 0):
+                user_messages = [m.content for m in memory.messages if m.type == "human"]
+                personal = personal_words(ai_response, user_messages, formatted_context)
+                if personal:
+                    print(f"Not caching an answer that repeats words from the conversation: {sorted(personal)}")
+                else:
+                    answer_cache.add(query_vector, ai_response, sources)
                 
         except Exception as e:
             print(f"Error in chain execution or guardail: {e}")
             await cl.Message(content="I'm sorry, an error occurred processing your request").send()
 
-    memory.chat_memory.add_ai_message(ai_response)
-    cl.user_session.set("memory",memory)
+    memory.add_ai_message(ai_response)
+    await session_store.update(session_id, memory.messages_state())
+
+    # Summarize older turns after the response has gone out, rather than on the next request
+    task = asyncio.create_task(update_summary(memory, session_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    observe(turn_seconds, time.perf_counter() - turn_start, source="llm")
 
 if __name__ == "__main__":
     cl.run()
\ No newline at end of file
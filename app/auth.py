@@ -0,0 +1,69 @@
+import os
+import csv
+import sqlite3
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+#### Credential store for password login ####
+
+class CredentialStore:
+    """Usernames and passwords in sqlite, looked up through the primary key index, with a small
+    in-process cache in front. Users are created once, on first login, and never overwritten;
+    sqlite's locking makes that safe when several worker processes share the same file."""
+
+    def __init__(self, path: str, csv_path: str = None, cache_size: int = 10000):
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL") # readers don't block the writer
+        self.db.execute("""CREATE TABLE IF NOT EXISTS users (
+                               username TEXT PRIMARY KEY,
+                               password TEXT NOT NULL,
+                               created_at TEXT NOT NULL)""")
+        self.db.commit()
+
+        if csv_path and os.path.exists(csv_path):
+            try:
+                self.migrate_csv(csv_path)
+            except FileNotFoundError:
+                pass # another worker already migrated it
+
+    def migrate_csv(self, csv_path: str):
+        """One-shot import of the old append-only CSV file. The first row for each user is their
+        original registration; later rows were appended on every login and are ignored."""
+        with open(csv_path, mode="r") as csvfile:
+            rows = [(row["username"], row["password"], row.get("created_at") or datetime.now().isoformat())
+                    for row in csv.DictReader(csvfile)]
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO users (username, password, created_at) VALUES (?, ?, ?)", rows)
+            self.db.commit()
+        os.replace(csv_path, csv_path + ".migrated")
+        print(f"Migrated {len(rows)} rows from {csv_path}")
+
+    def lookup(self, username: str):
+        with self.lock:
+            if username in self.cache:
+                self.cache.move_to_end(username)
+                return self.cache[username]
+            row = self.db.execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+            if row:
+                # Passwords are never changed, so cached entries can't go stale
+                self.cache[username] = row[0]
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            return row[0] if row else None
+
+    def authenticate(self, username: str, password: str) -> bool:
+        """Check a password, registering the user with it if the username is new"""
+        stored = self.lookup(username)
+        if stored is None:
+            with self.lock:
+                # If another worker registered this username first, theirs wins
+                self.db.execute("INSERT OR IGNORE INTO users (username, password, created_at) VALUES (?, ?, ?)",
+                                (username, password, datetime.now().isoformat()))
+                self.db.commit()
+            stored = self.lookup(username)
+        return stored == password
@@ -0,0 +1,426 @@
+import os
+import re
+import ast
+import csv
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+import contextvars
+from types import SimpleNamespace
+from typing import Any, AsyncIterator
+
+import numpy as np
+
+#### Offline end-to-end benchmark of the chat pipeline ####
+# Drives app.start() and app.main() with local stand-ins for every remote service: fake chat
+# models that stream tokens with a configurable latency, a fake embedding model, in-memory
+# Qdrant and a stub Eldercare SOAP service. Conversations are replayed from the ragas test set.
+#
+#   > python benchmark.py --concurrency 8                 # run and compare against the baseline
+#   > python benchmark.py --concurrency 8 --save-baseline # run and store the results as the baseline
+#   > python benchmark.py --concurrency 8 --workers 4     # the same load spread over four worker processes
+#                                                         # sharing a sqlite session store
+
+# Keep the app away from the real services and local state files before it is imported
+os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
+import vars
+vars.PASSWORD_FILE = None
+vars.PASSWORD_DB = ":memory:"
+vars.SESSION_STORE_URL = "sqlite:///:memory:"
+vars.EMBEDDING_CACHE_FILE = ":memory:"
+vars.ELDERCARE_WSDL_CACHE_FILE = None
+
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, get_buffer_string
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.models import Distance, PointStruct, VectorParams
+
+import app
+import utils
+from vars import HAIKU, SONNET, COLLECTION_NAME_FIXED, COLLECTION_NAME_SEMANTIC
+from memory import count_tokens
+from embedding_cache import CachedEmbeddings
+from lexical import BM25Index
+from metrics import stage_seconds
+from session_store import get_session_store
+
+DATA_FILE = "../notebooks/ragas_test_data.csv"
+BASELINE_FILE = "benchmark_baseline.json"
+LOCATION_QUESTIONS = ["Are there any services near 10001 that could help?",
+                      "What agencies can help us in Denver, CO?",
+                      "Can you find adult day care close to 94110?"]
+
+#### Stand-ins for the remote services ####
+
+def busy(seconds: float):
+    """Hold the CPU for `seconds`, unlike sleeping, so extra worker processes only help if there are cores to run them"""
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model. `respond` maps the prompt text to the reply, which is streamed
+    word by word after `first_token_latency`, with `token_latency` between words. `token_cpu` is
+    CPU time spent in the process per word, standing in for the app's own work on each chunk."""
+
+    model: str
+    respond: Any
+    first_token_latency: float = 0.5
+    token_latency: float = 0.02
+    token_cpu: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def reply(self, messages: list[BaseMessage]) -> AIMessage:
+        # The app's prompts send their text as content blocks
+        messages = [message.model_copy(update={"content": "".join(block["text"] for block in message.content)})
+                    if isinstance(message.content, list) else message for message in messages]
+        prompt = get_buffer_string(messages)
+        reply = self.respond(prompt)
+        if isinstance(reply, str):
+            reply = AIMessage(content=reply)
+        reply.usage_metadata = {"input_tokens": count_tokens(prompt), "output_tokens": count_tokens(reply.content),
+                                "total_tokens": count_tokens(prompt) + count_tokens(reply.content)}
+        return reply
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        reply = self.reply(messages)
+        time.sleep(self.first_token_latency + self.token_latency * len(reply.content.split()))
+        return ChatResult(generations=[ChatGeneration(message=reply)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        reply = self.reply(messages)
+        await asyncio.sleep(self.first_token_latency + self.token_latency * len(reply.content.split()))
+        busy(self.token_cpu * len(reply.content.split()))
+        return ChatResult(generations=[ChatGeneration(message=reply)])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        reply = self.reply(messages)
+        await asyncio.sleep(self.first_token_latency)
+        words = re.findall(r"\S+\s*", reply.content)
+        for i, word in enumerate(words):
+            # Usage is reported on the last chunk, like the Anthropic API does
+            usage = reply.usage_metadata if i == len(words) - 1 else None
+            busy(self.token_cpu)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word, usage_metadata=usage))
+            await asyncio.sleep(self.token_latency)
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words vectors, so similar texts get similar embeddings"""
+
+    def __init__(self, size: int = 256, latency: float = 0.05):
+        self.size = size
+        self.latency = latency
+
+    def vector(self, text: str) -> list[float]:
+        vector = np.zeros(self.size)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % self.size] += 1
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(self.latency)
+        return [self.vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+class StubSoapService:
+    """Answers the Eldercare operations the app uses, in the shape zeep returns them"""
+
+    def __init__(self, latency: float = 0.3):
+        self.latency = latency
+
+    async def login(self, username, password):
+        await asyncio.sleep(self.latency)
+        return "benchmark-token"
+
+    async def search(self, place: str):
+        await asyncio.sleep(self.latency)
+        agencies = [{"Table1": {"Name": f"{place} Area Agency on Aging {i}", "Address1": f"{i} Main St",
+                                "City": place, "StateCode": "NA", "ZipCode": "00000", "O_Phone": "555-0100",
+                                "EMailAdd": "info@example.org", "URL": "https://example.org",
+                                "Description": "Information and referral for older adults and caregivers"}}
+                    for i in range(1, 4)]
+        return {"_value_1": {"_value_1": agencies}}
+
+    async def SearchByZip(self, asToken, asZipCode):
+        return await self.search(asZipCode)
+
+    async def SearchByCityState(self, asToken, asCity, asState):
+        return await self.search(asCity)
+
+class BenchMessage:
+    """Stands in for cl.Message, and notes when the first token of a turn is streamed"""
+
+    def __init__(self, content: str = "", **kwargs):
+        self.content = content
+
+    async def stream_token(self, token: str):
+        turn = current_turn.get(None)
+        if turn is not None and turn.get("first_token") is None:
+            turn["first_token"] = time.perf_counter()
+        self.content += token
+
+    async def send(self):
+        return self
+
+current_thread = contextvars.ContextVar("current_thread")
+current_turn = contextvars.ContextVar("current_turn")
+
+class BenchContext:
+    @property
+    def session(self):
+        return SimpleNamespace(thread_id=current_thread.get())
+
+#### Setup ####
+
+def load_conversations(path: str, turns: int, location_turns: bool) -> tuple[list[list[str]], dict, list[str]]:
+    """Group the test questions into conversations. Returns (conversations, question -> answer, contexts)"""
+    with open(path, mode="r") as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    answers = {row["question"]: row["ground_truth"] for row in rows}
+    contexts = list(dict.fromkeys(context for row in rows for context in ast.literal_eval(row["contexts"])))
+
+    questions = [row["question"] for row in rows]
+    conversations = [questions[i:i + turns] for i in range(0, len(questions), turns)]
+    if location_turns:
+        for i, conversation in enumerate(conversations):
+            conversation.append(LOCATION_QUESTIONS[i % len(LOCATION_QUESTIONS)])
+    return conversations, answers, contexts
+
+def answer_for(answers: dict):
+    """Answer with the ground truth for whichever test question appears last in the prompt"""
+    def respond(prompt: str) -> str:
+        positions = {question: prompt.rfind(question) for question in answers}
+        question = max(positions, key=positions.get)
+        if positions[question] < 0:
+            return "I don't have information about that in my sources. Your local Area Agency on Aging can help."
+        return answers[question]
+    return respond
+
+def rewrite_or_summarize(prompt: str) -> str:
+    if "search query" in prompt:
+        inputs = re.findall(r"User input: (.*)", prompt)
+        return inputs[-1] if inputs else prompt[-200:]
+    return "The caregiver is asking about support for a family member with dementia."
+
+def route_tools(prompt: str) -> AIMessage:
+    zip_codes = re.findall(r"\b\d{5}\b", prompt)
+    city_states = re.findall(r"([A-Z][a-z]+), ([A-Z]{2})\b", prompt)
+    if zip_codes:
+        call = {"name": "search_by_zip", "args": {"zip_code": zip_codes[-1]}, "id": "call_1"}
+    elif city_states:
+        call = {"name": "search_by_city_state", "args": {"city": city_states[-1][0], "state": city_states[-1][1]}, "id": "call_1"}
+    else:
+        return AIMessage(content="No location given")
+    return AIMessage(content="", tool_calls=[call])
+
+async def load_qdrant(embeddings: FakeEmbeddings, contexts: list[str]) -> tuple[QdrantClient, AsyncQdrantClient]:
+    # The sync and async in-memory clients don't share storage, so both are loaded
+    vectors = embeddings.embed_documents(contexts)
+    points = [PointStruct(id=i, vector=vector,
+                          payload={"page_content": context, "metadata": {"url": f"https://example.org/source/{i}"}})
+              for i, (context, vector) in enumerate(zip(contexts, vectors))]
+    client = QdrantClient(":memory:")
+    async_client = AsyncQdrantClient(":memory:")
+    for name in [COLLECTION_NAME_FIXED, COLLECTION_NAME_SEMANTIC]:
+        client.create_collection(name, vectors_config=VectorParams(size=embeddings.size, distance=Distance.COSINE))
+        client.upsert(name, points=points)
+        await async_client.create_collection(name, vectors_config=VectorParams(size=embeddings.size, distance=Distance.COSINE))
+        await async_client.upsert(name, points=points)
+    return client, async_client
+
+async def install_stand_ins(args, answers: dict, contexts: list[str]):
+    """Swap the app's shared clients for local fakes"""
+    embeddings = FakeEmbeddings(latency=args.embedding_latency)
+    app.cl = SimpleNamespace(Message=BenchMessage, context=BenchContext())
+    app.qdrant_client, app.async_qdrant_client = await load_qdrant(embeddings, contexts)
+    app.openai_embeddings = CachedEmbeddings(embeddings, model="fake", path=":memory:")
+    chunks = [Document(page_content=context, metadata={"url": f"https://example.org/source/{i}"}) for i, context in enumerate(contexts)]
+    app.lexical_index = BM25Index.build({COLLECTION_NAME_FIXED: chunks, COLLECTION_NAME_SEMANTIC: chunks})
+
+    latency = {"first_token_latency": args.first_token_latency, "token_latency": args.token_latency, "token_cpu": args.token_cpu}
+    app.haiku_llm = FakeChatModel(model=HAIKU, respond=rewrite_or_summarize, **latency)
+    app.llm_with_tools = FakeChatModel(model=HAIKU, respond=route_tools, **latency)
+    app.sonnet_llm = app.llm = app.fact_fixer_llm = FakeChatModel(model=SONNET, respond=answer_for(answers), **latency)
+    # The checker finds no problems; its latency still counts for sentences the local scorer can't vouch for
+    app.fact_checker_llm = FakeChatModel(model=SONNET, respond=lambda prompt: "N", **latency)
+    app.retriever = app.init_retriever(app.haiku_llm)
+
+    stub = StubSoapService(latency=args.soap_latency)
+    eldercare = utils.get_eldercare_client()
+    eldercare.client = SimpleNamespace(service=stub)
+    eldercare.client_task = asyncio.get_running_loop().create_future()
+    eldercare.client_task.set_result(eldercare.client)
+
+#### Running and reporting ####
+
+async def run_conversation(conversation: list[str], turns: list[dict], think_time: float):
+    current_thread.set(f"benchmark-{random.getrandbits(64):x}")
+    await app.start()
+    for question in conversation:
+        turn = {"first_token": None}
+        current_turn.set(turn)
+        start = time.perf_counter()
+        await app.main(BenchMessage(content=question))
+        turn["latency"] = time.perf_counter() - start
+        turn["ttft"] = turn["first_token"] - start if turn["first_token"] else None
+        turns.append(turn)
+        await asyncio.sleep(think_time)
+
+def percentile(values: list[float], p: float) -> float:
+    return float(np.percentile(values, p)) if values else float("nan")
+
+def summarize(turns: list[dict], elapsed: float) -> dict:
+    latencies = [turn["latency"] for turn in turns]
+    ttfts = [turn["ttft"] for turn in turns if turn["ttft"] is not None]
+    results = {"turns": len(turns), "elapsed": elapsed, "throughput": len(turns) / elapsed}
+    for p in (50, 95, 99):
+        results[f"turn_p{p}"] = percentile(latencies, p)
+        results[f"ttft_p{p}"] = percentile(ttfts, p)
+    # Mean time per stage from the app's own metrics, to show where the time went
+    results["stages"] = {dict(key)["stage"]: total / count for key, (_, total, count) in stage_seconds.series.items()}
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return a description of every result that is worse than the baseline by more than the tolerance"""
+    regressions = []
+    for key in ("turn_p50", "turn_p95", "turn_p99", "ttft_p50", "ttft_p95", "ttft_p99"):
+        if key in baseline and results[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key}: {results[key]:.3f}s vs {baseline[key]:.3f}s baseline")
+    if "throughput" in baseline and results["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput: {results['throughput']:.2f} vs {baseline['throughput']:.2f} turns/s baseline")
+    return regressions
+
+async def run(args, worker: int = 0, barrier=None) -> tuple[list[dict], float, float]:
+    """Replay this worker's share of the conversations. Returns (turns, start, end), with wall clock
+    times so that several worker processes can be combined."""
+    random.seed(args.seed + worker)
+    conversations, answers, contexts = load_conversations(args.data, args.turns, not args.no_location_turns)
+    conversations = (conversations * (args.conversations // len(conversations) + 1))[:args.conversations]
+    conversations = conversations[worker::args.workers]
+    await install_stand_ins(args, answers, contexts)
+    if args.session_store:
+        app.session_store = get_session_store(args.session_store, ttl=vars.SESSION_TTL)
+    if barrier is not None:
+        barrier.wait() # start the load in every worker at once, after their setup
+
+    turns = []
+    # --concurrency is the total across workers, so runs with different --workers get the same load
+    semaphore = asyncio.Semaphore(args.concurrency // args.workers + (worker < args.concurrency % args.workers))
+    async def limited(conversation):
+        async with semaphore:
+            await run_conversation(conversation, turns, args.think_time)
+
+    start = time.time()
+    await asyncio.gather(*[limited(conversation) for conversation in conversations])
+    end = time.time()
+    await asyncio.gather(*app.background_tasks) # let the summary updates finish
+    return turns, start, end
+
+def run_worker(args, worker: int, barrier, queue):
+    turns, start, end = asyncio.run(run(args, worker, barrier))
+    queue.put((turns, start, end, stage_seconds.series))
+
+def run_workers(args) -> dict:
+    """Run the benchmark in `args.workers` processes sharing one session store, like a multi-worker
+    deployment. The conversations and the `args.concurrency` limit are split between the processes."""
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(args.workers)
+    queue = context.Queue()
+    processes = [context.Process(target=run_worker, args=(args, worker, barrier, queue)) for worker in range(args.workers)]
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    turns = [turn for worker_turns, _, _, _ in results for turn in worker_turns]
+    for _, _, _, series in results:
+        for key, (counts, total, count) in series.items():
+            merged = stage_seconds.series.get(key, ([0] * len(counts), 0.0, 0))
+            stage_seconds.series[key] = ([a + b for a, b in zip(merged[0], counts)], merged[1] + total, merged[2] + count)
+    return summarize(turns, max(end for _, _, end, _ in results) - min(start for _, start, _, _ in results))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay test conversations through the app with local stand-ins")
+    parser.add_argument("--data", default=DATA_FILE)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a result counts as a regression")
+    parser.add_argument("--conversations", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=3, help="test questions per conversation")
+    parser.add_argument("--no-location-turns", action="store_true", help="don't end each conversation with an Eldercare lookup")
+    parser.add_argument("--concurrency", type=int, default=5, help="conversations at a time, in total across workers")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing one session store")
+    parser.add_argument("--session-store", default=None, help="session store URL, e.g. sqlite:///sessions.db (default: in memory)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds between turns of a conversation")
+    parser.add_argument("--first-token-latency", type=float, default=0.5)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--token-cpu", type=float, default=0.0, help="CPU seconds spent per streamed word, on top of the app's own work")
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--soap-latency", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.workers > args.concurrency:
+        parser.error("--concurrency is split between the workers, so it must be at least --workers")
+
+    if args.workers > 1:
+        # Worker processes need a session store they can share
+        args.session_store = args.session_store or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'sessions.db')}"
+        results = run_workers(args)
+    else:
+        turns, start, end = asyncio.run(run(args))
+        results = summarize(turns, end - start)
+    print(f"\n{results['turns']} turns in {results['elapsed']:.2f} seconds ({results['throughput']:.2f} turns/s)")
+    for name in ("turn", "ttft"):
+        print(f"{name:>5}: p50 {results[name + '_p50']:.3f}s  p95 {results[name + '_p95']:.3f}s  p99 {results[name + '_p99']:.3f}s")
+    for stage, seconds in sorted(results["stages"].items(), key=lambda item: -item[1]):
+        print(f"  {stage:<24}{seconds:.3f}s")
+
+    # Only compare runs made with the same settings
+    results["settings"] = {key: value for key, value in args.__dict__.items() if key not in ("baseline", "save_baseline", "tolerance")}
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != results["settings"]:
+        print("Warning: the baseline was recorded with different settings")
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if regressions:
+        raise SystemExit(1)
+    print("No regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import re
+import asyncio
+from typing import AsyncIterator, Iterable, Optional
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+
+#### Batched semantic chunking ####
+# Splits documents exactly like langchain_experimental's SemanticChunker with percentile
+# breakpoints: every sentence is embedded together with its neighbours, and a chunk ends wherever
+# the distance between consecutive windows is in the top 5% for the document. Instead of one
+# embedding request per document, the windows of many documents share requests and several
+# requests run at once, and the window vectors can stand in for the chunks' own vectors.
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.?!])\s+")
+
+def sentence_windows(sentences: list[str], buffer_size: int = 1) -> list[str]:
+    """Each sentence joined with `buffer_size` sentences either side of it"""
+    return [" ".join(sentences[max(0, i - buffer_size):i + buffer_size + 1]) for i in range(len(sentences))]
+
+def breakpoint_ranges(vectors: list[list[float]], percentile: float = 95) -> list[tuple[int, int]]:
+    """(start, end) sentence ranges of the chunks for one document's window vectors"""
+    matrix = np.array(vectors, dtype=np.float64)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    distances = 1 - np.sum(matrix[:-1] * matrix[1:], axis=1)
+    threshold = np.percentile(distances, percentile)
+
+    ranges = []
+    start = 0
+    for i in np.nonzero(distances > threshold)[0]:
+        ranges.append((start, int(i) + 1))
+        start = int(i) + 1
+    if start < len(vectors):
+        ranges.append((start, len(vectors)))
+    return ranges
+
+class BatchedSemanticChunker:
+    """Semantic chunking for a whole corpus. With `chunk_vectors`, each chunk also gets the
+    normalized mean of its sentence windows' vectors, which saves embedding the chunks again at
+    the cost of vectors that are close to, but not the same as, the chunk's own embedding."""
+
+    def __init__(self, embeddings: Embeddings, breakpoint_percentile: float = 95, buffer_size: int = 1,
+                 batch_size: int = 512, max_concurrency: int = 4, chunk_vectors: bool = False):
+        self.embeddings = embeddings
+        self.breakpoint_percentile = breakpoint_percentile
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.chunk_vectors = chunk_vectors
+
+    async def embed_batch(self, batch: list[tuple[Document, list[str]]]) -> list[tuple[Document, list[str], list]]:
+        windows = [window for _, sentences in batch for window in sentence_windows(sentences, self.buffer_size)]
+        vectors = await self.embeddings.aembed_documents(windows)
+        results = []
+        for doc, sentences in batch:
+            results.append((doc, sentences, vectors[:len(sentences)]))
+            vectors = vectors[len(sentences):]
+        return results
+
+    def chunks(self, doc: Document, sentences: list[str], vectors: Optional[list] = None):
+        ranges = breakpoint_ranges(vectors, self.breakpoint_percentile) if vectors else [(0, len(sentences))]
+        for i, (start, end) in enumerate(ranges):
+            chunk = Document(page_content=" ".join(sentences[start:end]), metadata={**doc.metadata, "chunk_id": i})
+            vector = None
+            if self.chunk_vectors and vectors:
+                mean = np.mean(np.array(vectors[start:end], dtype=np.float32), axis=0)
+                vector = (mean / (np.linalg.norm(mean) + 1e-12)).tolist()
+            yield chunk, vector
+
+    async def split(self, docs: Iterable[Document]) -> AsyncIterator[tuple[Document, Optional[list[float]]]]:
+        """Yields (chunk, vector) for every chunk of every document, a batch of documents at a time as
+        their embeddings come back. The vector is None unless `chunk_vectors` is set."""
+        batch = []
+        batch_windows = 0
+        pending = set()
+
+        async def finished():
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            return [result for task in done for result in task.result()]
+
+        for doc in docs:
+            sentences = SENTENCE_SPLIT.split(doc.page_content)
+            if len(sentences) == 1:
+                # Nothing to split, so nothing to embed
+                for item in self.chunks(doc, sentences):
+                    yield item
+                continue
+            if batch and batch_windows + len(sentences) > self.batch_size:
+                pending.add(asyncio.ensure_future(self.embed_batch(batch)))
+                batch, batch_windows = [], 0
+            batch.append((doc, sentences))
+            batch_windows += len(sentences)
+
+            if len(pending) >= self.max_concurrency:
+                for doc_, sentences_, vectors in await finished():
+                    for item in self.chunks(doc_, sentences_, vectors):
+                        yield item
+
+        if batch:
+            pending.add(asyncio.ensure_future(self.embed_batch(batch)))
+        while pending:
+            for doc_, sentences_, vectors in await finished():
+                for item in self.chunks(doc_, sentences_, vectors):
+                    yield item
@@ -0,0 +1,348 @@
+import os
+import re
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import hashlib
+import argparse
+import contextlib
+from typing import Iterator, Optional
+from urllib.parse import urljoin, urldefrag, urlparse
+
+import httpx
+from langchain.schema import Document
+
+#### Concurrent, incremental crawler for the source documents ####
+# Replaces the one-seed-at-a-time RecursiveUrlLoader loop in notebooks/fetch_data.ipynb. Every seed
+# shares one pool of requests, with a limit per host and a minimum gap between requests to the same
+# host. A sqlite crawl index keeps each page's ETag/Last-Modified, text and links, so a refresh crawl
+# sends conditional GETs and only downloads and parses pages that changed. PDFs are parsed in memory,
+# and the corpus is written as JSON lines so chunking can read one document at a time.
+#
+#   > python crawler.py                 # crawl (or refresh) and write ../notebooks/source_documents.jsonl
+#   > python crawler.py --concurrency 4 --host-delay 1.0
+
+CORPUS_FILE = "../notebooks/source_documents.jsonl"
+CRAWL_INDEX_FILE = "../notebooks/crawl_index.db"
+MAX_CORPUS_SHRINK = 0.5 # refuse to replace the corpus with one that has more than this share fewer documents
+
+SEED_URLS = ["https://www.cdc.gov/alzheimers-dementia",
+             "https://www.cdc.gov/alzheimers-dementia/about",
+             "https://www.cdc.gov/alzheimers-dementia/prevention",
+             "https://www.cdc.gov/alzheimers-dementia/healthy-people-2030",
+             "https://www.alz.org/help-support/caregiving",
+             "https://www.mayoclinic.org/diseases-conditions/dementia/",
+             "https://www.alzheimers.org.uk/about-dementia"]
+
+PDF_URLS = ["https://www.cdc.gov/alzheimers-dementia/media/pdfs/2024/05/BrainHealthKeyFactsResources.pdf",
+            "https://www.caregiving.org/wp-content/uploads/2020/05/Dementia-Caregiving-in-the-US_February-2017.pdf",
+            "https://archrespite.org/wp-content/uploads/2021/12/9-Steps_Dementia-Caregiver-2.pdf"]
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.3 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0",
+    # Sites like mayo clinic and webmd block obvious bots
+]
+
+UNWANTED_TERMS = ["learn more", "get involved with your local chapter","Find a support group near you","join our community",
+                  "print this page","skip directly to site content","skip directly to search",
+                  "an official website of the united states government", "sign up for email updates",
+                  "skip to main content","skip navigation menu","share this page email whatsapp messenger", "make a donation",
+                  "here's how you know official websites use .gov a .gov website belongs to an official government organization in the united states. secure .gov websites use https a lock ( ) or https:// means you've safely connected to the .gov website. share sensitive information only on official, secure websites.",
+                  "email (required) first name (required) last name (required) you can change what you receive at any time and we will never sell your details to third parties. here’s our privacy policy ."]
+
+# Links to these are never followed (the same list RecursiveUrlLoader skips, minus .pdf)
+SKIPPED_EXTENSIONS = (".css", ".js", ".ico", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".csv", ".bz2", ".zip",
+                      ".epub", ".webp", ".mp3", ".mp4", ".xml", ".json")
+
+#### Parsing ####
+
+def parse_html(html: str, url: str) -> tuple[str, str, list[str]]:
+    """(title, text, links) for a page. Links are absolute and without fragments; they're taken
+    before the navigation is removed so the crawl can still follow menus."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "lxml")
+    title = soup.title.string if soup.title and soup.title.string else "No Title"
+    links = list(dict.fromkeys(urldefrag(urljoin(url, a["href"]))[0] for a in soup.find_all("a", href=True)))
+    for tag in soup(['nav', 'footer', 'header', 'aside', 'script', 'style']):
+        tag.decompose()
+    text = re.sub(r'\s+', ' ', soup.get_text(separator=' ', strip=True)).strip()
+    return title, text, links
+
+def parse_pdf(content: bytes) -> str:
+    """Text of a PDF, straight from the downloaded bytes"""
+    import pymupdf
+    with pymupdf.open(stream=content, filetype="pdf") as pdf:
+        # Skip the cover page, and the CDC fact sheet's running header and page numbers
+        pages = [page.get_text() for page in pdf][1:]
+    text = "\n".join(re.sub(r"Brain Health Key Facts and Resources \| 2014\s*|Page\s*\d+|\n{2,}", " ", page).strip()
+                     for page in pages)
+    return re.sub(r"\s{2,}", " ", text).strip()
+
+def keep_page(url: str, title: str, text: str) -> bool:
+    """Drop non-English pages, error pages and the sections that aren't about dementia care"""
+    content = text.lower()
+    return all([
+        "es-mx" not in url.lower(),
+        "doctors-departments" not in url,
+        "care-at-mayo-clinic" not in url,
+        "cuidado" not in title,
+        "site.html" not in url,
+        "page not found" not in title.lower(),
+        "404" not in title,
+        "500" not in title,
+        "403" not in title,
+        "page not found" not in content,
+        "access denied" not in content,
+        "runtime server error" not in content
+    ])
+
+def clean_text(text: str) -> str:
+    content = text.lower()
+    for term in UNWANTED_TERMS:
+        content = content.replace(term, "")
+    return content
+
+def is_pdf(url: str) -> bool:
+    return ".pdf" in url.lower()
+
+#### Crawl index ####
+
+class CrawlIndex:
+    """What the last crawl found at each URL: the validators for conditional GETs, a hash of the
+    body, and the parsed title, text and links so an unchanged page needn't be downloaded or parsed"""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS pages (
+                               url TEXT PRIMARY KEY,
+                               etag TEXT,
+                               last_modified TEXT,
+                               body_hash TEXT,
+                               title TEXT,
+                               text TEXT,
+                               links TEXT,
+                               fetched_at REAL NOT NULL)""")
+        self.db.commit()
+
+    def get(self, url: str) -> Optional[dict]:
+        row = self.db.execute("SELECT etag, last_modified, body_hash, title, text, links FROM pages WHERE url = ?",
+                              (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, body_hash, title, text, links = row
+        return {"etag": etag, "last_modified": last_modified, "body_hash": body_hash,
+                "title": title, "text": text, "links": json.loads(links)}
+
+    def put(self, url: str, page: dict):
+        self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (url, page.get("etag"), page.get("last_modified"), page.get("body_hash"),
+                         page["title"], page["text"], json.dumps(page["links"]), time.time()))
+        self.db.commit()
+
+#### Crawler ####
+
+class HostLimiter:
+    """At most `max_concurrency` requests in flight to each host, started at least `delay` seconds apart"""
+
+    def __init__(self, max_concurrency: int = 2, delay: float = 0.5):
+        self.max_concurrency = max_concurrency
+        self.delay = delay
+        self.semaphores = {}
+        self.next_start = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host: str):
+        semaphore = self.semaphores.setdefault(host, asyncio.Semaphore(self.max_concurrency))
+        async with semaphore:
+            now = time.monotonic()
+            start = max(now, self.next_start.get(host, now))
+            self.next_start[host] = start + self.delay
+            await asyncio.sleep(start - now)
+            yield
+
+class Crawler:
+    """Follows links from each seed to pages under the seed's URL, like RecursiveUrlLoader with
+    prevent_outside, up to `max_depth` links away. PDFs linked from those pages are fetched too."""
+
+    def __init__(self, index: CrawlIndex, concurrency: int = 16, host_concurrency: int = 2,
+                 host_delay: float = 0.5, max_depth: int = 6, timeout: float = 60, headers: Optional[dict] = None):
+        self.index = index
+        self.max_depth = max_depth
+        self.timeout = timeout
+        self.headers = headers or {"User-Agent": random.choice(USER_AGENTS)}
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.hosts = HostLimiter(host_concurrency, host_delay)
+        self.seen = set()
+        self.tasks = set()
+        self.active = 0
+        self.pages = asyncio.Queue() # (url, page) as each one is fetched, then None once the crawl is done
+        self.stats = {"fetched": 0, "not_modified": 0, "unchanged": 0, "failed": 0}
+
+    def enqueue(self, url: str, depth: int, prefix: Optional[str]):
+        if url in self.seen or urlparse(url).scheme not in ("http", "https"):
+            return
+        self.seen.add(url)
+        self.active += 1
+        task = asyncio.ensure_future(self.visit(url, depth, prefix))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def fetch(self, client: httpx.AsyncClient, url: str) -> Optional[dict]:
+        """The page at `url`, from the index if the server says it hasn't changed"""
+        cached = self.index.get(url)
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            async with self.hosts.slot(urlparse(url).netloc), self.semaphore:
+                response = await client.get(url, headers=headers)
+        except Exception as e:
+            print(f"Failed to fetch {url}: {e}")
+            self.stats["failed"] += 1
+            return cached # keep last crawl's copy rather than dropping the page
+        if response.status_code == 304 and cached:
+            self.stats["not_modified"] += 1
+            return cached
+        if response.status_code != 200:
+            print(f"Failed to fetch {url}: HTTP {response.status_code}")
+            self.stats["failed"] += 1
+            return cached # e.g. a 403, 429 or 503 on a refresh shouldn't drop the page either
+
+        # Servers that don't send validators still send the same body when nothing changed
+        body_hash = hashlib.sha256(response.content).hexdigest()
+        page = {"etag": response.headers.get("etag"), "last_modified": response.headers.get("last-modified"),
+                "body_hash": body_hash}
+        if cached and cached["body_hash"] == body_hash:
+            self.stats["unchanged"] += 1
+            page.update(title=cached["title"], text=cached["text"], links=cached["links"])
+        else:
+            self.stats["fetched"] += 1
+            content_type = response.headers.get("content-type", "")
+            try:
+                if is_pdf(url) or "application/pdf" in content_type:
+                    page.update(title="", text=await asyncio.to_thread(parse_pdf, response.content), links=[])
+                elif "html" in content_type or not content_type:
+                    title, text, links = await asyncio.to_thread(parse_html, response.text, url)
+                    page.update(title=title, text=text, links=links)
+                else:
+                    return None
+            except Exception as e:
+                print(f"Failed to parse {url}: {e}")
+                self.stats["failed"] += 1
+                return cached
+        self.index.put(url, page)
+        return page
+
+    async def visit(self, url: str, depth: int, prefix: Optional[str]):
+        try:
+            page = await self.fetch(self.client, url)
+            if page is None:
+                return
+            self.pages.put_nowait((url, page))
+            if prefix is None or depth >= self.max_depth:
+                return
+            for link in page["links"]:
+                if link.startswith(prefix) and not link.lower().endswith(SKIPPED_EXTENSIONS):
+                    # PDFs are documents of their own, but their links aren't followed
+                    self.enqueue(link, depth + 1, None if is_pdf(link) else prefix)
+        except Exception as e:
+            print(f"Failed to crawl {url}: {e}")
+            self.stats["failed"] += 1
+        finally:
+            # Links are queued before this, so the count only reaches 0 once everything is done
+            self.active -= 1
+            if self.active == 0:
+                self.pages.put_nowait(None)
+
+    async def crawl(self, seeds: list[str], pdfs: list[str] = ()):
+        """Yields (url, page) for every page reached, as soon as it has been fetched"""
+        async with httpx.AsyncClient(headers=self.headers, timeout=self.timeout, follow_redirects=True) as self.client:
+            for seed in seeds:
+                self.enqueue(seed, 0, seed)
+            for pdf in pdfs:
+                self.enqueue(pdf, 0, None)
+            if not self.active:
+                return
+            while (item := await self.pages.get()) is not None:
+                yield item
+
+def count_documents(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+async def crawl(corpus_file: str = CORPUS_FILE, index_file: str = CRAWL_INDEX_FILE, seeds: list[str] = SEED_URLS,
+                pdfs: list[str] = PDF_URLS, max_shrink: float = MAX_CORPUS_SHRINK, **kwargs) -> dict:
+    """Crawl the seeds and PDFs and write the filtered, de-duplicated corpus as JSON lines. The
+    file is replaced only once the crawl has finished, and not at all if the new corpus is empty or
+    has more than `max_shrink` fewer documents than the old one (pass max_shrink=1 to allow that)."""
+    crawler = Crawler(CrawlIndex(index_file), **kwargs)
+    seen_content = set()
+    written = 0
+    start = time.monotonic()
+    with open(corpus_file + ".tmp", "w", encoding="utf-8") as f:
+        async for url, page in crawler.crawl(seeds, pdfs):
+            if is_pdf(url):
+                doc = {"page_content": page["text"], "metadata": {"url": url}}
+            else:
+                if not keep_page(url, page["title"], page["text"]):
+                    continue
+                doc = {"page_content": clean_text(page["text"]), "metadata": {"url": url, "title": page["title"]}}
+            content_hash = hashlib.md5(doc["page_content"].encode("utf-8")).hexdigest()
+            if not doc["page_content"] or content_hash in seen_content:
+                continue
+            seen_content.add(content_hash)
+            f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+            written += 1
+
+    # A crawl where fetching or parsing broke shouldn't wipe out a good corpus
+    previous = count_documents(corpus_file)
+    if written == 0 or (max_shrink < 1 and written < previous * (1 - max_shrink)):
+        raise RuntimeError(f"The crawl found {written} documents, against {previous} in {corpus_file}, so the corpus "
+                           f"was not replaced. The new one is in {corpus_file}.tmp; use --allow-shrink to replace it anyway.")
+    os.replace(corpus_file + ".tmp", corpus_file)
+    return {**crawler.stats, "documents": written, "seconds": time.monotonic() - start}
+
+def read_corpus(path: str = CORPUS_FILE) -> Iterator[Document]:
+    """The documents in a crawled corpus, one at a time"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                yield Document(page_content=item["page_content"], metadata=item["metadata"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl the source websites and write the document corpus")
+    parser.add_argument("--corpus", default=CORPUS_FILE)
+    parser.add_argument("--index", default=CRAWL_INDEX_FILE, help="sqlite crawl index used for conditional requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight across all hosts")
+    parser.add_argument("--host-concurrency", type=int, default=2, help="requests in flight to any one host")
+    parser.add_argument("--host-delay", type=float, default=0.5, help="min seconds between requests to the same host")
+    parser.add_argument("--max-depth", type=int, default=6)
+    parser.add_argument("--allow-shrink", action="store_true", help="replace the corpus even if the crawl found far fewer documents")
+    args = parser.parse_args()
+
+    # The parsers are only in the notebook environment, and without them every page fails to parse
+    try:
+        import bs4, lxml, pymupdf
+    except ImportError as e:
+        raise SystemExit(f"{e}. Run the crawler in the notebook environment (notebook_requirements.txt).")
+
+    try:
+        stats = asyncio.run(crawl(args.corpus, args.index, max_shrink=1 if args.allow_shrink else MAX_CORPUS_SHRINK, concurrency=args.concurrency,
+                                  host_concurrency=args.host_concurrency, host_delay=args.host_delay, max_depth=args.max_depth))
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    print(f"Wrote {stats['documents']} documents to {args.corpus} in {stats['seconds']:.1f} seconds "
+          f"({stats['fetched']} fetched, {stats['not_modified'] + stats['unchanged']} unchanged, {stats['failed']} failed)")
+
+if __name__ == "__main__":
+    main()
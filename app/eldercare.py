@@ -0,0 +1,129 @@
+import re
+import time
+import asyncio
+from typing import Optional
+from collections import OrderedDict
+
+import httpx
+from zeep import AsyncClient
+from zeep.cache import SqliteCache
+from zeep.exceptions import Fault
+from zeep.transports import AsyncTransport
+
+#### Async client for the Eldercare SOAP API ####
+
+class EldercareClient:
+    """Async client for the Eldercare Data API. Re-uses one pooled HTTP connection and one
+    session token across calls, and caches search results since agency listings rarely change.
+    The WSDL is only fetched and parsed on first use (or by warm_up), in a worker thread, and the
+    WSDL/XSD documents are kept in a local sqlite cache so restarts don't depend on the remote site.
+    If loading fails, it is retried in the background with exponential backoff."""
+
+    def __init__(self, wsdl: str, username: str, password: str,
+                 token_ttl: float = 15*60, result_ttl: float = 24*60*60, max_results: int = 1000, max_connections: int = 10,
+                 wsdl_cache_path: Optional[str] = None, wsdl_cache_ttl: float = 30*24*60*60,
+                 wsdl_timeout: float = 10, retry_after: float = 5, max_retry_after: float = 10*60):
+        self.wsdl = wsdl
+        self.username = username
+        self.password = password
+        self.token_ttl = token_ttl
+        self.result_ttl = result_ttl
+        self.max_results = max_results
+
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=30
+        )
+        self.wsdl_cache = SqliteCache(path=wsdl_cache_path, timeout=wsdl_cache_ttl) if wsdl_cache_path else None
+        self.wsdl_timeout = wsdl_timeout
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+
+        self.client = None
+        self.client_task = None
+        self.load_failures = 0
+
+        self.token = None
+        self.token_time = 0.0
+        self.token_lock = asyncio.Lock()
+        self.results = OrderedDict()  # cache key -> (timestamp, result), least recently used first
+
+    def load(self) -> AsyncClient:
+        # Fetching and parsing the WSDL is blocking, so this runs in a worker thread. zeep's own
+        # default timeout for the WSDL download is 5 minutes, long enough to stall every tool call
+        start = time.perf_counter()
+        transport = AsyncTransport(client=self.http, cache=self.wsdl_cache, timeout=self.wsdl_timeout)
+        client = AsyncClient(wsdl=self.wsdl, transport=transport)
+        print(f"Loaded Eldercare WSDL in {time.perf_counter() - start:.3f} seconds")
+        return client
+
+    def warm_up(self) -> asyncio.Future:
+        """Start loading the WSDL in the background, without waiting for it to finish"""
+        if self.client_task is None:
+            self.client_task = asyncio.ensure_future(asyncio.to_thread(self.load))
+            self.client_task.add_done_callback(self.loaded)
+        return self.client_task
+
+    def loaded(self, task: asyncio.Future):
+        """Keep the client once the WSDL has loaded, or schedule the next attempt if it failed"""
+        if not task.cancelled() and task.exception() is None:
+            self.client = task.result()
+            self.load_failures = 0
+            return
+        self.client_task = None
+        self.load_failures += 1
+        delay = min(self.retry_after * 2**(self.load_failures - 1), self.max_retry_after)
+        print(f"Error loading Eldercare WSDL, retrying in {delay:g} seconds: {None if task.cancelled() else task.exception()}")
+        asyncio.get_running_loop().call_later(delay, self.warm_up)
+
+    async def get_client(self) -> AsyncClient:
+        if self.client is None:
+            # Between retries, fail fast rather than hammer the site with WSDL fetches on every tool call
+            if self.client_task is None and self.load_failures:
+                raise ConnectionError("Eldercare WSDL is unavailable, will retry later")
+            # Shielded, so a cancelled tool call doesn't cancel the load for everyone else
+            self.client = await asyncio.shield(self.warm_up())
+        return self.client
+
+    async def get_token(self, refresh: bool = False) -> str:
+        """Return the current session token, logging in again only if it is missing or stale"""
+        client = await self.get_client()
+        async with self.token_lock:
+            if refresh or not self.token or time.time() - self.token_time > self.token_ttl:
+                self.token = await client.service.login(self.username, self.password)
+                self.token_time = time.time()
+            return self.token
+
+    async def call(self, key: tuple, operation: str, **kwargs):
+        """Call a search operation, serving it from the result cache when possible"""
+        cached = self.results.get(key)
+        if cached and time.time() - cached[0] < self.result_ttl:
+            self.results.move_to_end(key)
+            return cached[1]
+
+        client = await self.get_client()
+        service_method = getattr(client.service, operation)
+        try:
+            result = await service_method(asToken=await self.get_token(), **kwargs)
+        except Fault as e:
+            # The token may have expired on the server side; log in again and retry once
+            print(f"Eldercare API fault, refreshing session token: {e}")
+            result = await service_method(asToken=await self.get_token(refresh=True), **kwargs)
+
+        self.results[key] = (time.time(), result)
+        self.results.move_to_end(key)
+        while len(self.results) > self.max_results:
+            self.results.popitem(last=False)
+        return result
+
+    async def search_by_zip(self, zip_code: str):
+        zip_code = re.sub(r"\D", "", zip_code)[:5]
+        return await self.call(("zip", zip_code), "SearchByZip", asZipCode=zip_code)
+
+    async def search_by_city_state(self, city: str, state: str):
+        city = " ".join(city.split()).title()
+        state = state.strip().upper()
+        return await self.call(("city_state", city.lower(), state), "SearchByCityState", asCity=city, asState=state)
+
+    async def close(self):
+        await self.http.aclose()
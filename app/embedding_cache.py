@@ -0,0 +1,199 @@
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+#### Two-tier (in-memory LRU + sqlite) cache in front of an embedding model ####
+
+def normalize_query(text: str) -> str:
+    """Normalize a user query so trivially different phrasings share a cache entry"""
+    return " ".join(text.lower().split())
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embedding model with a bounded in-memory LRU cache backed by a sqlite file that
+    survives restarts. Entries are keyed on the model name plus the (normalized, for queries) text."""
+
+    def __init__(self, embeddings: Embeddings, model: str, path: str,
+                 max_memory_items: int = 1000, max_disk_items: int = 40000, touch_batch_size: int = 256):
+        self.embeddings = embeddings
+        self.model = model
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.touch_batch_size = touch_batch_size
+
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # The memory tier is only ever locked briefly, so the event loop can use it directly. Async callers
+        # do the sqlite work on one worker thread; a single thread keeps it from contending with the
+        # event loop for the GIL, and sqlite writes are serialized anyway.
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                               key TEXT PRIMARY KEY,
+                               model TEXT NOT NULL,
+                               vector BLOB NOT NULL,
+                               last_used REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.db.commit()
+        self.disk_items = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] # kept up to date by store()
+        self.touched = {} # key -> time of a disk hit, written to last_used in batches
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-cache")
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\n{text}".encode("utf-8")).hexdigest()
+
+    def stats(self) -> dict:
+        """Hit/miss counters for both cache tiers"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hit_rate = (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits,
+                "misses": self.misses, "hit_rate": hit_rate}
+
+    def lookup_memory(self, keys: list[str]) -> dict:
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                    self.memory_hits += 1
+        return found
+
+    def lookup_disk(self, keys: list[str]) -> dict:
+        """Return vectors on disk for any of the keys, promoting them into memory. This blocks on
+        sqlite, so async callers run it in a thread."""
+        rows = []
+        if keys:
+            with self.db_lock:
+                # Stay under sqlite's limit on the number of query parameters
+                for i in range(0, len(keys), 500):
+                    batch = keys[i:i+500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows += self.db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                                            batch).fetchall()
+                now = time.time()
+                self.touched.update((key, now) for key, _ in rows)
+                if len(self.touched) >= self.touch_batch_size:
+                    self.flush_touched()
+                    self.db.commit()
+        found = {}
+        with self.lock:
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+                self.remember(key, found[key])
+                self.disk_hits += 1
+            self.misses += len(set(keys) - set(found))
+        return found
+
+    def flush_touched(self):
+        # Caller must hold self.db_lock, and commit
+        if self.touched:
+            self.db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                [(used, key) for key, used in self.touched.items()])
+            self.touched = {}
+
+    def lookup(self, keys: list[str]) -> dict:
+        """Return cached vectors for any of the keys we have"""
+        found = self.lookup_memory(keys)
+        found.update(self.lookup_disk(list(dict.fromkeys(key for key in keys if key not in found))))
+        return found
+
+    async def alookup(self, keys: list[str]) -> dict:
+        found = self.lookup_memory(keys)
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            found.update(await asyncio.get_running_loop().run_in_executor(self.executor, self.lookup_disk, missing))
+        return found
+
+    def store_disk(self, items: dict):
+        """Write newly computed vectors to disk. When there are more than max_disk_items rows, the least
+        recently used are evicted down to 90% of the bound, so eviction only runs every so often."""
+        now = time.time()
+        with self.db_lock:
+            cursor = self.db.executemany("INSERT OR IGNORE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                                         [(key, self.model, array("f", vector).tobytes(), now) for key, vector in items.items()])
+            self.disk_items += cursor.rowcount
+            if self.disk_items > self.max_disk_items:
+                self.flush_touched()
+                cursor = self.db.execute("""DELETE FROM embeddings WHERE key IN
+                                            (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)""",
+                                         (self.disk_items - int(0.9 * self.max_disk_items),))
+                self.disk_items -= cursor.rowcount
+            self.db.commit()
+
+    def store(self, items: dict):
+        """Add newly computed vectors to both tiers"""
+        if not items:
+            return
+        with self.lock:
+            for key, vector in items.items():
+                self.remember(key, vector)
+        self.store_disk(items)
+
+    async def astore(self, items: dict):
+        if not items:
+            return
+        with self.lock:
+            for key, vector in items.items():
+                self.remember(key, vector)
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.store_disk, items)
+
+    def remember(self, key: str, vector: list[float]):
+        # Caller must hold self.lock
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def split(self, texts: list[str]):
+        keys = [self.key(text) for text in texts]
+        found = self.lookup(keys)
+        # Only embed each distinct missing text once
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        return keys, found, missing
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, found, missing = self.split(texts)
+        if missing:
+            new = dict(zip([self.key(text) for text in missing], self.embeddings.embed_documents(missing)))
+            self.store(new)
+            found.update(new)
+        return [found[key] for key in keys]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self.key(text) for text in texts]
+        found = await self.alookup(keys)
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        if missing:
+            new = dict(zip([self.key(text) for text in missing], await self.embeddings.aembed_documents(missing)))
+            await self.astore(new)
+            found.update(new)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self.key(normalize_query(text))
+        found = self.lookup([key])
+        if key not in found:
+            found[key] = self.embeddings.embed_query(text)
+            self.store({key: found[key]})
+        return found[key]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self.key(normalize_query(text))
+        found = await self.alookup([key])
+        if key not in found:
+            found[key] = await self.embeddings.aembed_query(text)
+            await self.astore({key: found[key]})
+        return found[key]
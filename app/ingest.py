@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import argparse
+from typing import AsyncIterable, Iterable, Optional, Union
+
+from dotenv import load_dotenv
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from qdrant_client import AsyncQdrantClient, models
+
+from vars import COLLECTION_NAME_FIXED, COLLECTION_NAME_SEMANTIC, URL, LEXICAL_INDEX_FILE, VECTOR_STORAGE
+from vars import EMBEDDING_MODEL, EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MEMORY_SIZE, EMBEDDING_CACHE_DISK_SIZE
+from vector_storage import TruncatedEmbeddings, storage_embeddings, collection_options
+from lexical import BM25Index
+from crawler import CORPUS_FILE, read_corpus
+from chunking import BatchedSemanticChunker
+
+#### Incremental ingestion into the Qdrant collections ####
+# Every chunk's point ID is a hash of its content, so a re-run can tell which chunks are new,
+# changed or gone and only embeds the new text. Each run builds a fresh collection, copying the
+# vectors of everything that didn't change, and then moves the app's collection name (a Qdrant
+# alias) over to it in one step, so searches never see a missing or half-loaded collection.
+#
+#   > python ingest.py                # chunk ../notebooks/source_documents.jsonl and update both collections
+#   > python ingest.py --in-place     # upsert and delete in the live collections instead of rebuilding them
+#   > python ingest.py --allow-shrink # go ahead even if most of the existing chunks would be removed
+
+MAX_REMOVED_SHARE = 0.5 # abort, leaving the live collection alone, if more than this share of its chunks would go
+
+def point_id(doc: Document) -> str:
+    """A UUID derived from the chunk's text and metadata, so the same chunk always gets the same ID"""
+    content = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}, sort_keys=True, default=str)
+    return str(uuid.UUID(hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]))
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def split_fixed(docs: list[Document], chunk_size: int = 1500, chunk_overlap: int = 150) -> list[Document]:
+    """Fixed-size chunks, numbered within each page"""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [Document(page_content=split, metadata={**doc.metadata, "chunk_id": i})
+            for doc in docs for i, split in enumerate(text_splitter.split_text(doc.page_content))]
+
+async def current_collection(client: AsyncQdrantClient, name: str) -> Optional[str]:
+    """The collection the alias `name` points to, `name` itself for a collection created before
+    aliases were used, or None"""
+    for alias in (await client.get_aliases()).aliases:
+        if alias.alias_name == name:
+            return alias.collection_name
+    return name if await client.collection_exists(name) else None
+
+async def scroll_points(client: AsyncQdrantClient, collection: str) -> dict:
+    """{point ID as a string: point} for every point in the collection, without the vectors"""
+    records = {}
+    offset = None
+    while True:
+        points, offset = await client.scroll(collection, limit=1000, offset=offset, with_payload=True, with_vectors=False)
+        records.update((str(point.id), point) for point in points)
+        if offset is None:
+            return records
+
+async def wait_until_indexed(client: AsyncQdrantClient, collection: str, timeout: float = 300):
+    deadline = time.monotonic() + timeout
+    while (await client.get_collection(collection)).status != models.CollectionStatus.GREEN:
+        if time.monotonic() > deadline:
+            print(f"{collection} is still indexing; searches may be slower until it finishes")
+            return
+        await asyncio.sleep(1)
+
+async def ingest_collection(client: AsyncQdrantClient, name: str, docs: Union[Iterable[Document], AsyncIterable[Document]],
+                            embeddings: Embeddings, storage: dict = VECTOR_STORAGE, vectors: Optional[dict] = None,
+                            in_place: bool = False, batch_size: int = 64, max_concurrency: int = 4, keep_old: bool = False,
+                            max_removed: float = MAX_REMOVED_SHARE) -> dict:
+    """Make the collection (alias) `name` hold exactly `docs`, embedding only chunks whose text isn't
+    already in it. `embeddings` should already be the storage embeddings for `storage`. `docs` can
+    be an async iterator, e.g. from BatchedSemanticChunker, so chunks are loaded while later ones are
+    still being made. `vectors` ({text: full-size vector}) can supply vectors for new chunks instead
+    of embedding them; it is read as each batch is loaded, so it can be filled in as chunks arrive.
+
+    By default the chunks are loaded into a new collection and the alias is switched to it once it's
+    ready. With `in_place`, new and changed chunks are upserted into the live collection and removed
+    ones deleted, which is quicker but means searches can briefly see a mix of old and new chunks.
+
+    If `docs` is empty, or more than `max_removed` of the existing chunks would be removed (e.g. after
+    a crawl that failed), nothing is switched or deleted and RuntimeError is raised."""
+    vectors = vectors if vectors is not None else {}
+    old = await current_collection(client, name)
+    existing = await scroll_points(client, old) if old else {}
+    dimensions = storage.get("dimensions", 3072)
+    if old and (await client.get_collection(old)).config.params.vectors.size != dimensions:
+        print(f"{old} has a different vector size from VECTOR_STORAGE; every chunk will be embedded again")
+        existing = {}
+        in_place = False
+
+    if in_place and old:
+        target = old
+    else:
+        in_place = False
+        target = f"{name}_{time.strftime('%Y%m%d_%H%M%S')}"
+        vector_params, create_options = collection_options(storage)
+        await client.create_collection(
+            target,
+            vectors_config=models.VectorParams(size=dimensions, distance=models.Distance.COSINE, **vector_params),
+            **create_options
+        )
+
+    # Chunks whose metadata changed (e.g. renumbered after an edit earlier in the page) get a new ID,
+    # but their vector can still be copied from the point with the same text
+    by_text = {text_key((point.payload or {}).get("page_content", "")): id for id, point in existing.items()}
+    wanted = {}
+    copies = [] # (new ID, ID of the existing point to copy the vector from)
+    new = []
+    tasks = []
+    stats = {"unchanged": 0, "moved": 0, "embedded": 0, "precomputed": 0, "removed": 0}
+
+    def payload(id: str) -> dict:
+        return {"page_content": wanted[id].page_content, "metadata": wanted[id].metadata}
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def copy_batch(batch: list[tuple[str, str]]):
+        async with semaphore:
+            # Points loaded before this script have random IDs, which may not be strings
+            points = await client.retrieve(old, ids=[existing[source].id for source in set(source for _, source in batch)],
+                                           with_vectors=True, with_payload=False)
+            found = {str(point.id): point.vector for point in points}
+            await client.upsert(target, points=[models.PointStruct(id=id, vector=found[source], payload=payload(id))
+                                                for id, source in batch], wait=True)
+
+    async def embed_batch(ids: list[str]):
+        async with semaphore:
+            texts = [wanted[id].page_content for id in ids]
+            missing = [text for text in texts if text not in vectors]
+            found = dict(zip(missing, await embeddings.aembed_documents(missing))) if missing else {}
+            precomputed = [text for text in texts if text not in found]
+            if precomputed:
+                full_size = [vectors[text] for text in precomputed]
+                # Cut down to the stored size the same way as embedded vectors
+                if isinstance(embeddings, TruncatedEmbeddings):
+                    full_size = embeddings.truncate(full_size)
+                found.update(zip(precomputed, full_size))
+            stats["embedded"] += len(missing)
+            stats["precomputed"] += len(precomputed)
+            await client.upsert(target, points=[models.PointStruct(id=id, vector=found[text], payload=payload(id))
+                                                for id, text in zip(ids, texts)], wait=True)
+
+    def add(doc: Document):
+        id = point_id(doc)
+        if id in wanted:
+            return
+        wanted[id] = doc
+        if id in existing:
+            stats["unchanged"] += 1
+            if not in_place:
+                copies.append((id, id))
+        elif text_key(doc.page_content) in by_text:
+            stats["moved"] += 1
+            copies.append((id, by_text[text_key(doc.page_content)]))
+        else:
+            new.append(id)
+        # Start each batch as soon as it's full
+        if len(copies) >= batch_size:
+            tasks.append(asyncio.ensure_future(copy_batch(copies[:])))
+            copies.clear()
+        if len(new) >= batch_size:
+            tasks.append(asyncio.ensure_future(embed_batch(new[:])))
+            new.clear()
+
+    try:
+        if hasattr(docs, "__aiter__"):
+            async for doc in docs:
+                add(doc)
+        else:
+            for doc in docs:
+                add(doc)
+        if copies:
+            tasks.append(asyncio.ensure_future(copy_batch(copies)))
+        if new:
+            tasks.append(asyncio.ensure_future(embed_batch(new)))
+        await asyncio.gather(*tasks)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        if not in_place:
+            await client.delete_collection(target)
+        raise
+
+    removed = [id for id in existing if id not in wanted]
+    stats["removed"] = len(removed)
+    print(f"{name}: {stats['unchanged']} unchanged, {stats['moved']} moved, {stats['embedded']} embedded, "
+          f"{stats['precomputed']} precomputed, {stats['removed']} removed")
+
+    # An empty or much smaller corpus is far more likely to be a broken crawl than a real change
+    if not wanted or (existing and len(removed) > max_removed * len(existing)):
+        if not in_place:
+            await client.delete_collection(target)
+        raise RuntimeError(f"{name}: {len(removed)} of {len(existing)} existing chunks would be removed and {len(wanted)} kept; "
+                           f"stopped before deleting or switching anything. Use --allow-shrink if that's intended.")
+
+    if in_place:
+        for i in range(0, len(removed), 1000):
+            await client.delete(target, points_selector=models.PointIdsList(points=[existing[id].id for id in removed[i:i+1000]]),
+                                wait=True)
+        return {"collection": target, **stats}
+
+    await wait_until_indexed(client, target)
+    operations = []
+    if old == name:
+        # A collection from before aliases were used has to be removed before the alias can take its
+        # name, so searches fail for the moment in between. This only happens on the first run.
+        await client.delete_collection(old)
+    elif old:
+        operations.append(models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=name)))
+    operations.append(models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=target, alias_name=name)))
+    # Both operations are applied together, so the alias never points at nothing
+    await client.update_collection_aliases(change_aliases_operations=operations)
+    if old and old != name and not keep_old:
+        await client.delete_collection(old)
+    print(f"{name} now points to {target}")
+    return {"collection": target, **stats}
+
+async def run(args):
+    from langchain_openai import OpenAIEmbeddings
+    from embedding_cache import CachedEmbeddings
+
+    load_dotenv('.env')
+    # Shares the app's cache, so text that was ever embedded before costs nothing
+    openai_embeddings = CachedEmbeddings(
+        OpenAIEmbeddings(model=EMBEDDING_MODEL, openai_api_key=os.getenv("OPENAI_API_KEY")),
+        model=EMBEDDING_MODEL,
+        path=EMBEDDING_CACHE_FILE,
+        max_memory_items=EMBEDDING_CACHE_MEMORY_SIZE,
+        max_disk_items=EMBEDDING_CACHE_DISK_SIZE
+    )
+    vector_embeddings = storage_embeddings(openai_embeddings, VECTOR_STORAGE)
+
+    docs = list(read_corpus(args.source))
+    split_docs = split_fixed(docs)
+    client = AsyncQdrantClient(url=args.url, prefer_grpc=True)
+    max_removed = 1 if args.allow_shrink else MAX_REMOVED_SHARE
+    await ingest_collection(client, COLLECTION_NAME_FIXED, split_docs, vector_embeddings, in_place=args.in_place,
+                            batch_size=args.batch_size, max_concurrency=args.concurrency, keep_old=args.keep_old,
+                            max_removed=max_removed)
+
+    # Semantic chunks are loaded as they're made, with the mean of their sentence vectors if asked for
+    chunker = BatchedSemanticChunker(openai_embeddings, max_concurrency=args.concurrency,
+                                     chunk_vectors=args.chunk_vectors == "sentences")
+    semantic_split_docs = []
+    chunk_vectors = {}
+
+    async def semantic_chunks():
+        async for chunk, vector in chunker.split(docs):
+            semantic_split_docs.append(chunk)
+            if vector is not None:
+                chunk_vectors[chunk.page_content] = vector
+            yield chunk
+
+    await ingest_collection(client, COLLECTION_NAME_SEMANTIC, semantic_chunks(), vector_embeddings, vectors=chunk_vectors,
+                            in_place=args.in_place, batch_size=args.batch_size, max_concurrency=args.concurrency,
+                            keep_old=args.keep_old, max_removed=max_removed)
+    print(f"{len(docs)} docs, {len(split_docs)} fixed chunks, {len(semantic_split_docs)} semantic chunks")
+
+    lexical_index = BM25Index.build({COLLECTION_NAME_FIXED: split_docs, COLLECTION_NAME_SEMANTIC: semantic_split_docs})
+    lexical_index.save(LEXICAL_INDEX_FILE)
+    print(f"Indexed {len(lexical_index.chunks)} chunks in {LEXICAL_INDEX_FILE}; restart the app to load it")
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the Qdrant collections from the scraped documents")
+    parser.add_argument("--source", default=CORPUS_FILE, help="corpus written by crawler.py")
+    parser.add_argument("--url", default=URL)
+    parser.add_argument("--in-place", action="store_true", help="update the live collections instead of building new ones")
+    parser.add_argument("--keep-old", action="store_true", help="don't delete the previous collections after switching")
+    parser.add_argument("--allow-shrink", action="store_true", help="switch even if most of the existing chunks would be removed")
+    parser.add_argument("--batch-size", type=int, default=64, help="chunks per embedding request and upsert")
+    parser.add_argument("--concurrency", type=int, default=4, help="batches in flight at once")
+    parser.add_argument("--chunk-vectors", choices=["embed", "sentences"], default="embed",
+                        help="embed new semantic chunks, or use the mean of their sentence vectors")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import re
+import math
+import gzip
+import json
+import heapq
+from collections import Counter
+
+from langchain.schema import Document
+
+#### In-process BM25 index over the same chunks as the Qdrant collections ####
+# Built at ingestion time (see notebooks/chunk_and_load_data.ipynb) and loaded when the app starts.
+# It finds exact terms that embeddings tend to miss, such as drug and agency names, and needs no
+# network calls, so retrieval still works when the embedding service is slow or down.
+
+TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = set("""a about an and are as at be been but by can could do does for from had has have how i if in
+into is it its me my of on or our she should so than that the their them there these they this those to was
+we were what when where which who why will with would you your""".split())
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """Okapi BM25 over a list of chunks. Each chunk keeps its text, metadata and the collection it
+    was loaded into, so search results look like the dense retriever's."""
+
+    def __init__(self, chunks: list[dict], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+
+        self.postings = {} # term -> list of (chunk index, term frequency)
+        lengths = []
+        for i, chunk in enumerate(chunks):
+            terms = Counter(tokenize(chunk["page_content"]))
+            lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                self.postings.setdefault(term, []).append((i, frequency))
+        average_length = sum(lengths) / len(lengths) if lengths else 0
+        self.norms = [k1 * (1 - b + b * length / average_length) if average_length else k1 for length in lengths]
+        self.idf = {term: math.log(1 + (len(chunks) - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for term, docs in self.postings.items()}
+
+    @classmethod
+    def build(cls, docs_by_collection: dict[str, list[Document]], **kwargs):
+        """Index the chunks loaded into each Qdrant collection, e.g. {collection_name: split_docs}"""
+        chunks = [{"page_content": doc.page_content, "metadata": doc.metadata, "collection_name": name}
+                  for name, docs in docs_by_collection.items() for doc in docs]
+        return cls(chunks, **kwargs)
+
+    def save(self, path: str):
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "chunks": self.chunks}, f)
+
+    @classmethod
+    def load(cls, path: str):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["chunks"], k1=data["k1"], b=data["b"])
+
+    def search(self, query: str, k: int = 10) -> list[tuple[float, dict]]:
+        """The top k chunks for the query as (score, chunk), best first"""
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, frequency in self.postings[term]:
+                scores[i] = scores.get(i, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + self.norms[i])
+        best = heapq.nlargest(k, scores, key=scores.get)
+        return [(scores[i], self.chunks[i]) for i in best]
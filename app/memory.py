@@ -0,0 +1,118 @@
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, get_buffer_string
+from langchain_core.language_models.chat_models import BaseChatModel
+
+from scheduler import get_scheduler
+from vars import SUMMARY_PROMPT
+
+#### Conversation memory with per-consumer token budgets and a rolling summary ####
+
+def count_tokens(text: str) -> int:
+    # Rough estimate (about 4 characters per token) that avoids a tokenizer API call
+    return len(text) // 4 + 1
+
+class SummarizedMemory:
+    """Keeps the full conversation, plus a rolling summary of older turns. Each consumer asks for
+    history within its own token budget, so prompt sizes stay flat however long the session gets.
+    `budget` is the smallest of those budgets: the summary is kept far enough along that it and the
+    un-summarized messages fit in it, so no consumer cuts a message that isn't in the summary.
+    The summary is updated off the request path."""
+
+    def __init__(self, budget: int = 500, headroom: float = 0.25):
+        self.messages = []
+        self.summary = ""
+        self.summarized = 0  # number of messages already folded into the summary
+        self.budget = budget
+        self.headroom = headroom  # share of the budget left free for the next user message
+
+    @classmethod
+    def from_state(cls, state: dict, **kwargs):
+        """Rebuild memory from the fields written by messages_state() and summary_state()"""
+        memory = cls(**kwargs)
+        for message_type, content in state.get("messages", []):
+            memory.messages.append(HumanMessage(content=content) if message_type == "human" else AIMessage(content=content))
+        memory.load_summary(state)
+        return memory
+
+    def load_summary(self, state: dict):
+        """Take the summary fields from a stored state, e.g. ones written since this memory was loaded"""
+        self.summary, self.summarized = state.get("summary", ["", 0])
+
+    def messages_state(self) -> dict:
+        return {"messages": [[message.type, message.content] for message in self.messages]}
+
+    def summary_state(self) -> dict:
+        return {"summary": [self.summary, self.summarized]}
+
+    def add_user_message(self, text: str):
+        self.messages.append(HumanMessage(content=text))
+
+    def add_ai_message(self, text: str):
+        self.messages.append(AIMessage(content=text))
+
+    def recent(self, budget: int, step: int = 1) -> list[BaseMessage]:
+        """The newest messages that fit in the budget. The latest message is always included.
+        update_summary keeps the summary far enough along that the smallest budget still reaches
+        back to it; larger budgets also get some of the summarized messages word for word.
+        With `step`, old messages are dropped that many at a time, so the first message stays the same
+        for several turns and the history keeps a stable prefix for prompt caching."""
+        start = len(self.messages)
+        used = 0
+        for message in reversed(self.messages):
+            used += count_tokens(message.content)
+            if used > budget and start < len(self.messages):
+                break
+            start -= 1
+        rounded = -(-start // step) * step
+        if start <= self.summarized:
+            # Don't round past the end of the summary, or messages would be in neither
+            rounded = min(rounded, self.summarized)
+        start = min(rounded, len(self.messages) - 1)
+        return self.messages[max(start, 0):]
+
+    def summary_message(self) -> str:
+        return f"Summary of the earlier conversation: {self.summary}" if self.summary else ""
+
+    def messages_for(self, budget: int) -> list[BaseMessage]:
+        """History as chat messages for the query rewriter and tool router"""
+        if not self.summary:
+            return self.recent(budget)
+        summary = SystemMessage(content=self.summary_message())
+        return [summary] + self.recent(budget - count_tokens(summary.content))
+
+    def history_lines(self, budget: int, step: int = 1) -> list[str]:
+        """History as one line of text per message, for the answer prompt, where each line is a
+        separate block so that one turn's history is a prefix of the next turn's"""
+        lines = []
+        if self.summary:
+            lines.append(self.summary_message() + "\n")
+        used = sum(count_tokens(line) for line in lines)
+        return lines + [get_buffer_string([message]) + "\n" for message in self.recent(budget - used, step)]
+
+    async def update_summary(self, llm: BaseChatModel) -> bool:
+        """Fold older messages into the summary once the summary and the un-summarized messages leave
+        less than `headroom` of the smallest budget for the next turn. The newest messages that fit in
+        half of the rest are kept word for word. Meant to run in the background after a response has
+        been sent, one at a time per session. Returns True if the summary changed."""
+        limit = int(self.budget * (1 - self.headroom))
+        unsummarized = self.messages[self.summarized:]
+        if count_tokens(self.summary_message()) + sum(count_tokens(m.content) for m in unsummarized) <= limit:
+            return False
+        cutoff = len(self.messages)
+        used = 0
+        for message in reversed(unsummarized):
+            used += count_tokens(message.content)
+            if used > limit // 2:
+                break
+            cutoff -= 1
+        if cutoff == self.summarized:
+            return False
+        try:
+            prompt = SUMMARY_PROMPT.format(summary=self.summary,
+                                           new_lines=get_buffer_string(self.messages[self.summarized:cutoff]))
+            response = await get_scheduler(llm).invoke(llm, prompt)
+            self.summary = response.content
+            self.summarized = cutoff
+            return True
+        except Exception as e:
+            print(f"Failed to update conversation summary: {e}")
+            return False
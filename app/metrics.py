@@ -0,0 +1,131 @@
+import time
+from contextlib import contextmanager
+
+from vars import METRICS_ENABLED
+
+#### Per-stage latency and token metrics, in the Prometheus text format ####
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (0, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+def format_labels(labels: tuple) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in labels)
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series = {} # sorted label items -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total, count = self.series.get(key, ([0] * len(self.buckets), 0.0, 0))
+        counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+        self.series[key] = (counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self.series.items():
+            labels = format_labels(key)
+            prefix = f"{labels}," if labels else ""
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.series = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for key, value in self.series.items():
+            lines.append(f"{self.name}{{{format_labels(key)}}} {value}")
+        return lines
+
+class Gauge:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.series = {}
+
+    def set(self, value: float, **labels):
+        self.series[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for key, value in self.series.items():
+            lines.append(f"{self.name}{{{format_labels(key)}}} {value}")
+        return lines
+
+stage_seconds = Histogram("carecompanion_stage_seconds", "Time spent in each stage of a chat turn")
+ttft_seconds = Histogram("carecompanion_time_to_first_token_seconds", "Time from receiving a message to streaming the first token")
+turn_seconds = Histogram("carecompanion_turn_seconds", "Total time to handle a chat turn")
+llm_tokens = Histogram("carecompanion_llm_tokens", "Tokens used by each LLM call", buckets=TOKEN_BUCKETS)
+llm_calls = Counter("carecompanion_llm_calls_total", "LLM calls, including retries")
+cached_input_ratio = Histogram("carecompanion_llm_cached_input_ratio", "Share of each LLM call's input tokens read from the prompt cache",
+                               buckets=(0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 1))
+answer_cache_lookups = Counter("carecompanion_answer_cache_lookups_total", "Answer cache lookups, by result")
+answer_cache_hit_rate = Gauge("carecompanion_answer_cache_hit_rate", "Share of answer cache lookups that were hits since the process started")
+
+def observe(histogram: Histogram, value: float, **labels):
+    if METRICS_ENABLED:
+        histogram.observe(value, **labels)
+
+@contextmanager
+def span(stage: str):
+    """Time a stage of the pipeline, e.g. `with span("retrieval"): ...`"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+async def timed(stage: str, awaitable):
+    """Time an awaitable, for stages that run concurrently under asyncio.gather"""
+    with span(stage):
+        return await awaitable
+
+def record_llm_call(model: str, usage: dict = None, failed: bool = False):
+    """Count a model call and the tokens it used, from a response's usage_metadata"""
+    if not METRICS_ENABLED:
+        return
+    llm_calls.inc(model=model, outcome="error" if failed else "ok")
+    if usage:
+        input_tokens = usage.get("input_tokens", 0)
+        llm_tokens.observe(input_tokens, model=model, type="input")
+        llm_tokens.observe(usage.get("output_tokens", 0), model=model, type="output")
+        # input_tokens includes the prompt cache reads and writes, which are billed at 0.1x and 1.25x
+        details = usage.get("input_token_details") or {}
+        cache_read = details.get("cache_read") or 0
+        cache_creation = details.get("cache_creation") or 0
+        llm_tokens.observe(cache_read, model=model, type="input_cache_read")
+        llm_tokens.observe(cache_creation, model=model, type="input_cache_creation")
+        llm_tokens.observe(input_tokens - cache_read - cache_creation, model=model, type="input_uncached")
+        if input_tokens:
+            cached_input_ratio.observe(cache_read / input_tokens, model=model)
+
+def record_answer_cache_lookup(hit: bool, hit_rate: float):
+    if not METRICS_ENABLED:
+        return
+    answer_cache_lookups.inc(result="hit" if hit else "miss")
+    answer_cache_hit_rate.set(hit_rate)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in (stage_seconds, ttft_seconds, turn_seconds, llm_tokens, llm_calls, cached_input_ratio,
+                   answer_cache_lookups, answer_cache_hit_rate):
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
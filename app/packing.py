@@ -0,0 +1,118 @@
+import re
+from typing import Optional
+
+import numpy as np
+from langchain.schema import Document
+
+from memory import count_tokens
+
+#### Post-retrieval context packing ####
+# Both collections chunk the same pages, so a search often returns the same passage twice (or
+# neighbouring chunks that share their overlap). Duplicates are merged, the rest are diversified
+# with maximal marginal relevance and packed into a token budget.
+
+WORD = re.compile(r"\w+")
+
+def shingles(text: str, size: int = 5) -> set:
+    """Hashes of the overlapping `size`-word sequences in the text. The hashes are only comparable
+    within one process, which is all that's needed to compare the chunks of one search."""
+    words = WORD.findall(text.lower())
+    if len(words) < size:
+        return {hash(tuple(words))}
+    return set(map(hash, zip(*(words[i:] for i in range(size)))))
+
+def containment(a: set, b: set) -> float:
+    """Fraction of the smaller shingle set that is also in the other one"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+def stitch(first: str, second: str, min_overlap: int = 8, max_overlap: int = 60) -> Optional[str]:
+    """Join two chunks if the end of the first repeats at the start of the second, as consecutive
+    fixed-size chunks do. Returns None if they don't overlap by at least `min_overlap` words.
+    Larger overlaps than `max_overlap` are left to the containment check."""
+    first_words = first.split()
+    second_words = second.split()
+    for size in range(min(len(first_words), len(second_words), max_overlap), min_overlap - 1, -1):
+        if first_words[-size:] == second_words[:size]:
+            return first + " " + " ".join(second_words[size:])
+    return None
+
+def merge_duplicates(docs: list[Document], threshold: float = 0.8) -> list[Document]:
+    """Merge near-duplicate and overlapping chunks, keeping the rank of the best-ranked one"""
+    merged = []
+    merged_shingles = []
+    for doc in docs:
+        doc_shingles = shingles(doc.page_content)
+        for i, kept in enumerate(merged):
+            if containment(doc_shingles, merged_shingles[i]) >= threshold:
+                # The same passage, or one inside the other: keep the longer text
+                if len(doc.page_content) > len(kept.page_content):
+                    merged[i] = Document(page_content=doc.page_content, metadata=kept.metadata)
+                    merged_shingles[i] = doc_shingles
+                break
+            if doc.metadata.get("url") and doc.metadata.get("url") == kept.metadata.get("url"):
+                text = stitch(kept.page_content, doc.page_content) or stitch(doc.page_content, kept.page_content)
+                if text:
+                    merged[i] = Document(page_content=text, metadata=kept.metadata)
+                    merged_shingles[i] = merged_shingles[i] | doc_shingles
+                    break
+        else:
+            merged.append(doc)
+            merged_shingles.append(doc_shingles)
+    return merged
+
+def similarity_matrix(docs: list[Document]) -> np.ndarray:
+    """Cosine similarity of the chunks' Qdrant vectors for pairs where both chunks have one, and
+    shingle overlap for the other pairs, e.g. with a chunk that only the lexical index found"""
+    vectors = [doc.metadata.get("_vector") for doc in docs]
+    with_vector = [i for i, vector in enumerate(vectors) if vector is not None]
+    if len(with_vector) < len(docs):
+        doc_shingles = [shingles(doc.page_content) for doc in docs]
+        similarity = np.array([[containment(a, b) for b in doc_shingles] for a in doc_shingles])
+    else:
+        similarity = np.zeros((len(docs), len(docs)))
+    if with_vector:
+        matrix = np.array([vectors[i] for i in with_vector], dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+        similarity[np.ix_(with_vector, with_vector)] = matrix @ matrix.T
+    return similarity
+
+def relevance_scores(docs: list[Document]) -> np.ndarray:
+    """Relevance on one 0-1 scale for every chunk: the fused score from retrieval relative to the
+    best one, or the rank for chunks that weren't retrieved through fusion"""
+    scores = np.array([doc.metadata.get("_fused_score", np.nan) for doc in docs], dtype=np.float64)
+    if np.isnan(scores).any():
+        return 1 - np.arange(len(docs)) / len(docs)
+    return scores / (scores.max() or 1)
+
+def mmr_order(docs: list[Document], lambda_mult: float = 0.7) -> list[Document]:
+    """Order chunks by maximal marginal relevance"""
+    if len(docs) < 2:
+        return list(docs)
+    relevance = relevance_scores(docs)
+    similarity = similarity_matrix(docs)
+
+    selected = [int(np.argmax(relevance))]
+    remaining = [i for i in range(len(docs)) if i != selected[0]]
+    while remaining:
+        redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+        scores = lambda_mult * relevance[remaining] - (1 - lambda_mult) * redundancy
+        best = remaining[int(np.argmax(scores))]
+        selected.append(best)
+        remaining.remove(best)
+    return [docs[i] for i in selected]
+
+def pack_context(docs: list[Document], token_budget: int = 2000, lambda_mult: float = 0.7,
+                 duplicate_threshold: float = 0.8) -> list[Document]:
+    """Dedupe, diversify and fill the token budget. Chunks that don't fit are skipped in favour of
+    smaller ones further down; the best chunk is always included."""
+    packed = []
+    used = 0
+    for doc in mmr_order(merge_duplicates(docs, duplicate_threshold), lambda_mult):
+        tokens = count_tokens(doc.page_content)
+        if packed and used + tokens > token_budget:
+            continue
+        packed.append(doc)
+        used += tokens
+    return packed
@@ -0,0 +1,49 @@
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from vars import PROMPT_CACHING, ANSWER_SYSTEM_PROMPT, ANSWER_HISTORY_HEADER, ANSWER_PROMPT
+from vars import FACT_CHECKER_SYSTEM_PROMPT, FACT_CHECKER_CONTEXT, FACT_CHECKER_PROMPT
+from vars import FACT_FIXER_SYSTEM_PROMPT, FACT_FIXER_PROMPT
+
+#### Prompt layout for Anthropic prompt caching ####
+# Every prompt starts with a static system prompt, followed by the parts that change from call to
+# call, most stable first. A cache breakpoint (cache_control) on a block asks Anthropic to cache
+# the prompt up to and including that block; a later request that starts with exactly the same
+# blocks reads them from the cache instead of processing them again. Prefixes shorter than the
+# model's minimum (1024 tokens for Sonnet, 2048 for Haiku) are not cached, so on its own the
+# system prompt is too short, but together with the history or the context that follows it is not.
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+def text_block(text: str, cache: bool = False) -> dict:
+    block = {"type": "text", "text": text}
+    if cache:
+        block["cache_control"] = CACHE_CONTROL
+    return block
+
+def answer_messages(history: list[str], context: str, tool_output: str, query: str,
+                    cache: bool = PROMPT_CACHING) -> list[BaseMessage]:
+    """Messages for the answer prompt. The history is sent one line per block, with a breakpoint
+    after the last line, so the next turn in the session can read this turn's history from the cache."""
+    lines = [ANSWER_HISTORY_HEADER + history[0]] + history[1:]
+    blocks = [text_block(line) for line in lines[:-1]] + [text_block(lines[-1], cache)]
+    blocks.append(text_block(ANSWER_PROMPT.format(context=context, tool_output=tool_output, query=query)))
+    return [SystemMessage(content=[text_block(ANSWER_SYSTEM_PROMPT, cache)]), HumanMessage(content=blocks)]
+
+def fact_checker_messages(context: str, tool_output: str, ai_response: str,
+                          cache: bool = PROMPT_CACHING) -> list[BaseMessage]:
+    """Messages for the fact checker. Every batch in a turn is checked against the same context,
+    so it gets a breakpoint and only the first check in a turn has to process it."""
+    return [
+        SystemMessage(content=[text_block(FACT_CHECKER_SYSTEM_PROMPT, cache)]),
+        HumanMessage(content=[text_block(FACT_CHECKER_CONTEXT.format(context=context, tool_output=tool_output), cache),
+                              text_block(FACT_CHECKER_PROMPT.format(ai_response=ai_response))])
+    ]
+
+def fact_fixer_messages(history: str, context: str, tool_output: str, ai_response: str,
+                        cache: bool = PROMPT_CACHING) -> list[BaseMessage]:
+    """Messages for the fact fixer, laid out like the fact checker's"""
+    return [
+        SystemMessage(content=[text_block(FACT_FIXER_SYSTEM_PROMPT, cache)]),
+        HumanMessage(content=[text_block(FACT_CHECKER_CONTEXT.format(context=context, tool_output=tool_output), cache),
+                              text_block(FACT_FIXER_PROMPT.format(history=history, ai_response=ai_response))])
+    ]
@@ -0,0 +1,113 @@
+import asyncio
+from typing import Optional
+
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.models import ScoredPoint, SearchParams
+
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+
+from lexical import BM25Index
+from metrics import span
+
+#### Retriever that searches several Qdrant collections with a single query embedding ####
+
+class FusedQdrantRetriever(BaseRetriever):
+    """Embeds the query once, searches every collection with that vector and merges the
+    results with reciprocal rank fusion (the same scoring EnsembleRetriever uses). With a
+    lexical index, its BM25 results are fused in too, and are used on their own if the
+    embedding service or Qdrant is slow or down."""
+
+    client: QdrantClient
+    async_client: AsyncQdrantClient
+    embeddings: Embeddings
+    collection_names: list[str]
+    k: int = 10
+    c: int = 60 # rank constant for reciprocal rank fusion
+    weights: Optional[list[float]] = None # one per collection, then one for the lexical index if there is one
+    search_params: Optional[SearchParams] = None # e.g. rescoring for quantized collections
+    with_vectors: bool = False # return the stored vectors as metadata["_vector"], e.g. for MMR
+    lexical_index: Optional[BM25Index] = None # BM25 results are fused with the dense ones
+    embedding_timeout: Optional[float] = None # seconds to wait for the query embedding before using only the lexical index
+    content_payload_key: str = "page_content"
+    metadata_payload_key: str = "metadata"
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        lexical = self.lexical_search(query)
+        with span("query_embedding"):
+            vector = self.embeddings.embed_query(query)
+        with span("qdrant_search"):
+            dense = [
+                self.to_documents(self.client.query_points(collection_name=name, query=vector, limit=self.k, with_payload=True,
+                                                           search_params=self.search_params, with_vectors=self.with_vectors).points, name)
+                for name in self.collection_names
+            ]
+        return self.fuse(dense + lexical)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> list[Document]:
+        lexical = self.lexical_search(query)
+        # Without a lexical index there is nothing to fall back on, so a slow embedding is waited for
+        timeout = self.embedding_timeout if self.lexical_index is not None else None
+        try:
+            with span("query_embedding"):
+                vector = await asyncio.wait_for(self.embeddings.aembed_query(query), timeout)
+
+            # Qdrant can't batch a search across collections, so send them all concurrently instead
+            with span("qdrant_search"):
+                responses = await asyncio.gather(*[
+                    self.async_client.query_points(collection_name=name, query=vector, limit=self.k, with_payload=True,
+                                                   search_params=self.search_params, with_vectors=self.with_vectors)
+                    for name in self.collection_names
+                ])
+        except Exception as e:
+            if not lexical:
+                raise
+            print(f"Dense retrieval failed ({type(e).__name__}: {e}), answering from the lexical index only")
+            return self.fuse(lexical)
+        dense = [self.to_documents(response.points, name) for response, name in zip(responses, self.collection_names)]
+        return self.fuse(dense + lexical)
+
+    def lexical_search(self, query: str) -> list[list[Document]]:
+        """BM25 results as one more ranked list to fuse, or no lists if there's no lexical index"""
+        if self.lexical_index is None:
+            return []
+        with span("lexical_search"):
+            results = self.lexical_index.search(query, self.k)
+        return [[Document(page_content=chunk["page_content"],
+                          metadata={**chunk["metadata"], "_collection_name": chunk["collection_name"], "_bm25_score": score})
+                 for score, chunk in results]]
+
+    def fuse(self, results: list[list[Document]]) -> list[Document]:
+        """Combine ranked lists of documents using weighted reciprocal rank fusion. The fused score
+        is kept as metadata["_fused_score"]."""
+        weights = self.weights if self.weights and len(self.weights) == len(results) else [1 / len(results)] * len(results)
+
+        scores = {}
+        docs = {}
+        for ranked_docs, weight in zip(results, weights):
+            for rank, doc in enumerate(ranked_docs, start=1):
+                # Same passage from both collections counts as one document, like EnsembleRetriever.
+                # Dense results come first, so their Qdrant score and vector are the ones kept.
+                key = doc.page_content
+                scores[key] = scores.get(key, 0.0) + weight / (rank + self.c)
+                docs.setdefault(key, doc)
+
+        # Every result gets its fused score, so later stages can compare dense and lexical hits on one scale
+        ranked_keys = sorted(scores, key=scores.get, reverse=True)
+        return [Document(page_content=key, metadata={**docs[key].metadata, "_fused_score": scores[key]}) for key in ranked_keys]
+
+    def to_documents(self, points: list[ScoredPoint], collection_name: str) -> list[Document]:
+        return [self.to_document(point, collection_name) for point in points]
+
+    def to_document(self, point: ScoredPoint, collection_name: str) -> Document:
+        """Convert a Qdrant point into a Document, matching the metadata QdrantVectorStore adds"""
+        payload = point.payload or {}
+        metadata = dict(payload.get(self.metadata_payload_key) or {})
+        metadata["_id"] = point.id
+        metadata["_collection_name"] = collection_name
+        metadata["_score"] = point.score
+        if isinstance(point.vector, list):
+            metadata["_vector"] = point.vector
+        return Document(page_content=payload.get(self.content_payload_key, ""), metadata=metadata)
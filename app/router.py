@@ -0,0 +1,110 @@
+import os
+import re
+
+from langchain_core.messages import BaseMessage
+
+#### Fast local check for whether an Eldercare API lookup is plausible ####
+# Most turns never mention a place, and the API can't be used without one, so we only ask the
+# tool-calling LLM when the conversation contains a location and the user seems to want local resources.
+
+ZIP_CODE = re.compile(r"\b\d{5}(?:-\d{4})?\b")
+
+STATES = {
+    "AL": "alabama", "AK": "alaska", "AZ": "arizona", "AR": "arkansas", "CA": "california",
+    "CO": "colorado", "CT": "connecticut", "DE": "delaware", "DC": "district of columbia",
+    "FL": "florida", "GA": "georgia", "HI": "hawaii", "ID": "idaho", "IL": "illinois",
+    "IN": "indiana", "IA": "iowa", "KS": "kansas", "KY": "kentucky", "LA": "louisiana",
+    "ME": "maine", "MD": "maryland", "MA": "massachusetts", "MI": "michigan", "MN": "minnesota",
+    "MS": "mississippi", "MO": "missouri", "MT": "montana", "NE": "nebraska", "NV": "nevada",
+    "NH": "new hampshire", "NJ": "new jersey", "NM": "new mexico", "NY": "new york",
+    "NC": "north carolina", "ND": "north dakota", "OH": "ohio", "OK": "oklahoma", "OR": "oregon",
+    "PA": "pennsylvania", "RI": "rhode island", "SC": "south carolina", "SD": "south dakota",
+    "TN": "tennessee", "TX": "texas", "UT": "utah", "VT": "vermont", "VA": "virginia",
+    "WA": "washington", "WV": "west virginia", "WI": "wisconsin", "WY": "wyoming", "PR": "puerto rico"
+}
+
+# Abbreviations that are also common words or acronyms only count after a city, e.g. "Portland, OR"
+AMBIGUOUS_STATES = {"IN", "OR", "ME", "OK", "HI", "DE", "ID", "MD", "CO", "OH", "PA", "MA", "AL", "LA", "MS"}
+UNAMBIGUOUS_STATE = re.compile(r"\b(" + "|".join(sorted(set(STATES) - AMBIGUOUS_STATES)) + r")\b")
+CITY_STATE = re.compile(r"\b[A-Z][a-z]+(?: [A-Z][a-z]+)*, ?(" + "|".join(STATES) + r")\b")
+STATE_NAME = re.compile(r"\b(" + "|".join(STATES.values()) + r")\b")
+
+# Towns that aren't in the city list still count when the sentence says someone lives there, e.g. "lives in
+# Boulder", or when a request for local resources names a place, e.g. "adult day care in Chapel Hill"
+NOT_PLACES = r"(?!(?:Assisted|Memory|Nursing|Independent|Hospice|Medicare|Medicaid|January|February|March|April|May|June|July" \
+             r"|August|September|October|November|December|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday)\b)"
+PLACE_AFTER_CUE = re.compile(r"\b(?:[Ll]ives?|[Ll]iving|[Ll]ocated|[Bb]ased|[Mm]oved|[Ss]tay(?:s|ing)?)"
+                             r" (?:in|to|near|outside(?: of)?) " + NOT_PLACES + r"[A-Z][a-z]+")
+PLACE_AFTER_PREPOSITION = re.compile(r"\b(?:in|near|around) " + NOT_PLACES + r"[A-Z][a-z]+")
+
+# The assistant asking where the user is, so that a bare answer like "Springfield" counts as a location
+LOCATION_QUESTION = re.compile(r"\b(?:what|which) (?:city|town|state|county|area)\b|\bzip code\b|\byour (?:city|town|location)\b"
+                               r"|\bwhere (?:do|does|are|is)\b[^?.]*\b(?:live|located|based)\b", re.IGNORECASE)
+
+# Largest US cities; extend with a gazetteer file of one city name per line
+CITIES = {
+    "new york", "los angeles", "chicago", "houston", "phoenix", "philadelphia", "san antonio",
+    "san diego", "dallas", "san jose", "austin", "jacksonville", "fort worth", "columbus",
+    "charlotte", "indianapolis", "san francisco", "seattle", "denver", "oklahoma city", "nashville",
+    "el paso", "boston", "portland", "las vegas", "detroit", "memphis", "louisville", "baltimore",
+    "milwaukee", "albuquerque", "tucson", "fresno", "sacramento", "kansas city", "mesa", "atlanta",
+    "omaha", "colorado springs", "raleigh", "long beach", "virginia beach", "miami", "oakland",
+    "minneapolis", "tulsa", "bakersfield", "wichita", "arlington", "tampa", "new orleans",
+    "cleveland", "honolulu", "anaheim", "lexington", "stockton", "henderson", "pittsburgh",
+    "st louis", "saint louis", "cincinnati", "orlando", "newark", "buffalo", "st paul", "saint paul",
+    "brooklyn", "queens", "the bronx", "manhattan", "salt lake city", "boise", "richmond", "hartford",
+    "providence", "birmingham", "little rock", "des moines", "madison", "spokane", "anchorage"
+}
+
+INTENT_PHRASES = [
+    "near me", "nearby", "in my area", "close to me", "around here", "in my town", "in my city",
+    "in my county", "in my state", "local", "where can i find", "where do i find", "where can we find",
+    "eldercare", "elder care", "agency", "agencies", "resources", "services", "program",
+    "adult day", "day care", "daycare", "respite", "home care", "in-home", "nursing home",
+    "memory care", "assisted living", "support group", "caregiver support", "meals on wheels",
+    "transportation", "i live in", "we live in", "she lives in", "he lives in", "zip"
+]
+
+def load_gazetteer(path: str) -> set:
+    """Read extra city names, one per line, to extend the built-in list"""
+    cities = set()
+    if os.path.exists(path):
+        with open(path, mode="r") as f:
+            cities = {line.strip().lower().replace(".", "") for line in f if line.strip()}
+    return cities
+
+def has_location(text: str, cities: set = CITIES) -> bool:
+    if ZIP_CODE.search(text) or CITY_STATE.search(text) or UNAMBIGUOUS_STATE.search(text) or PLACE_AFTER_CUE.search(text):
+        return True
+    lowered = text.lower()
+    if STATE_NAME.search(lowered):
+        return True
+    # Check every 1-3 word sequence against the city index
+    words = [word.strip(".'") for word in re.findall(r"[a-z.']+", lowered)]
+    for n in (1, 2, 3):
+        for i in range(len(words) - n + 1):
+            if " ".join(words[i:i+n]) in cities:
+                return True
+    return False
+
+def has_intent(text: str) -> bool:
+    lowered = text.lower()
+    return any(phrase in lowered for phrase in INTENT_PHRASES)
+
+def asks_for_location(message: BaseMessage) -> bool:
+    return message.type == "ai" and isinstance(message.content, str) and bool(LOCATION_QUESTION.search(message.content))
+
+def needs_eldercare_lookup(messages: list[BaseMessage], cities: set = CITIES, lookback: int = 6) -> bool:
+    """True if the latest user message could lead to an Eldercare API call: it mentions a location
+    itself or answers the assistant's question about one, or it asks for local resources and a
+    location came up in the recent conversation"""
+    located = [] # whether each user message gave a location
+    for i, message in enumerate(messages):
+        if message.type == "human" and isinstance(message.content, str):
+            located.append(has_location(message.content, cities) or (i > 0 and asks_for_location(messages[i - 1])))
+    if not located:
+        return False
+    if located[-1]:
+        return True
+    latest = [m.content for m in messages if m.type == "human" and isinstance(m.content, str)][-1]
+    return has_intent(latest) and (bool(PLACE_AFTER_PREPOSITION.search(latest)) or any(located[-lookback:-1]))
@@ -0,0 +1,181 @@
+import time
+import random
+import asyncio
+from typing import AsyncGenerator
+
+from vars import MODEL_LIMITS
+from metrics import record_llm_call
+
+#### Shared scheduling for all LLM calls: concurrency limits, rate limiting, retries and a circuit breaker ####
+# Every session's calls to the same model go through one ModelScheduler, so when the API is
+# overloaded we queue and back off together instead of retrying in lockstep. Each worker process
+# has its own schedulers, so any limits here add up across the processes.
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a model whose circuit breaker is open"""
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ModelScheduler:
+    """Schedules calls to one model. Waiting time for a slot is tracked so callers can tell when
+    the model is overloaded, and repeated failures open a circuit breaker for `reset_timeout` seconds."""
+
+    def __init__(self, name: str, max_concurrency: int = 8, requests_per_second: float = None, burst: int = 8,
+                 max_attempts: int = 3, base_delay: float = 1, max_delay: float = 20,
+                 failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Without a rate, calls are only held back after the API has answered 429
+        self.bucket = TokenBucket(requests_per_second, burst) if requests_per_second else None
+        self.paused_until = 0.0
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.queue_wait = 0.0 # moving average of seconds spent waiting for a slot
+        self.queue_wait_updated = time.monotonic()
+        self.queue_wait_half_life = 10.0 # so the average recovers once traffic moves elsewhere
+
+    @property
+    def circuit_open(self) -> bool:
+        # After reset_timeout the circuit is half-open: calls are let through, and one more failure re-opens it
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if not self.circuit_open:
+                print(f"{self.name}: opening circuit breaker after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+    def backoff(self, attempt: int) -> float:
+        # Full jitter, so that sessions that failed together don't retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def record_rate_limited(self, error: Exception, attempt: int):
+        """Hold back every call to the model after a 429, for as long as the API asks if it says"""
+        response = getattr(error, "response", None)
+        retry_after = getattr(response, "headers", {}).get("retry-after")
+        try:
+            delay = min(self.max_delay, float(retry_after))
+        except (TypeError, ValueError):
+            delay = self.backoff(attempt)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        print(f"{self.name}: rate limited, pausing calls for {delay:.1f} seconds")
+
+    async def acquire(self):
+        if self.circuit_open:
+            raise CircuitOpenError(f"{self.name} is unavailable, circuit breaker is open")
+        start = time.monotonic()
+        await self.semaphore.acquire()
+        try:
+            while (pause := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(pause)
+            if self.bucket:
+                await self.bucket.acquire()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        self.queue_wait = 0.8 * self.current_queue_wait() + 0.2 * (time.monotonic() - start)
+        self.queue_wait_updated = time.monotonic()
+
+    def current_queue_wait(self) -> float:
+        elapsed = time.monotonic() - self.queue_wait_updated
+        return self.queue_wait * 0.5 ** (elapsed / self.queue_wait_half_life)
+
+    async def invoke(self, llm, prompt):
+        for attempt in range(self.max_attempts):
+            await self.acquire()
+            try:
+                result = await llm.ainvoke(prompt)
+                self.record_success()
+                record_llm_call(self.name, getattr(result, "usage_metadata", None))
+                return result
+            except Exception as e:
+                self.record_failure()
+                record_llm_call(self.name, failed=True)
+                if getattr(e, "status_code", None) == 429:
+                    self.record_rate_limited(e, attempt)
+                if attempt == self.max_attempts - 1 or self.circuit_open:
+                    raise
+                delay = self.backoff(attempt)
+                print(f"{self.name}: attempt {attempt + 1} failed ({e}), retrying in {delay:.1f} seconds...")
+            finally:
+                self.semaphore.release()
+            await asyncio.sleep(delay)
+
+    async def stream(self, llm, prompt) -> AsyncGenerator:
+        for attempt in range(self.max_attempts):
+            await self.acquire()
+            started = False
+            usage = {"input_tokens": 0, "output_tokens": 0, "input_token_details": {}} # reported in pieces across the chunks
+            try:
+                async for chunk in llm.astream(prompt):
+                    started = True
+                    for key, value in (getattr(chunk, "usage_metadata", None) or {}).items():
+                        if key == "input_token_details":
+                            for detail, count in value.items():
+                                usage[key][detail] = usage[key].get(detail, 0) + (count or 0)
+                        elif key in usage:
+                            usage[key] += value
+                    yield chunk
+                self.record_success()
+                record_llm_call(self.name, usage)
+                return
+            except Exception as e:
+                self.record_failure()
+                record_llm_call(self.name, usage, failed=True)
+                if getattr(e, "status_code", None) == 429:
+                    self.record_rate_limited(e, attempt)
+                # Retrying after part of the answer was sent would repeat it
+                if started or attempt == self.max_attempts - 1 or self.circuit_open:
+                    raise
+                delay = self.backoff(attempt)
+                print(f"{self.name}: attempt {attempt + 1} failed ({e}), retrying in {delay:.1f} seconds...")
+            finally:
+                self.semaphore.release()
+            await asyncio.sleep(delay)
+
+    def overloaded(self, latency_slo: float) -> bool:
+        """True when calls are waiting longer than the SLO for a slot, or the circuit is open"""
+        return self.circuit_open or self.current_queue_wait() > latency_slo
+
+schedulers = {}
+
+def model_name(llm) -> str:
+    # Tool-bound models are RunnableBindings that wrap the chat model
+    return getattr(llm, "model", None) or getattr(getattr(llm, "bound", None), "model", "default")
+
+def get_scheduler(llm) -> ModelScheduler:
+    """The process-wide scheduler for the llm's model, created from MODEL_LIMITS on first use"""
+    name = model_name(llm)
+    if name not in schedulers:
+        schedulers[name] = ModelScheduler(name, **MODEL_LIMITS.get(name, {}))
+    return schedulers[name]
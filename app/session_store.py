@@ -0,0 +1,91 @@
+import json
+import time
+import zlib
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#### Shared storage for per-conversation state, so any worker process can serve any turn ####
+# State is a dict of named fields. Fields are written independently, so the background summary
+# update can't overwrite messages saved by a newer turn.
+
+def encode(value) -> bytes:
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+
+def decode(blob: bytes):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+class SqliteSessionStore:
+    """Session state in a local sqlite file shared by all worker processes on a machine. Queries run
+    on a worker thread so they don't block the event loop, and expired rows are deleted by the
+    first write after every `purge_interval` seconds."""
+
+    def __init__(self, path: str, ttl: float = 7*24*60*60, purge_interval: float = 60*60):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.last_purge = 0.0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS session_state (
+                               session_id TEXT NOT NULL,
+                               field TEXT NOT NULL,
+                               value BLOB NOT NULL,
+                               updated_at REAL NOT NULL,
+                               PRIMARY KEY (session_id, field))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS session_state_updated_at ON session_state (updated_at)")
+        self.db.commit()
+
+    def read(self, session_id: str) -> dict:
+        with self.lock:
+            rows = self.db.execute("SELECT field, value FROM session_state WHERE session_id = ? AND updated_at > ?",
+                                   (session_id, time.time() - self.ttl)).fetchall()
+        return {field: decode(value) for field, value in rows}
+
+    def write(self, session_id: str, fields: dict):
+        now = time.time()
+        rows = [(session_id, field, encode(value), now) for field, value in fields.items()]
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO session_state (session_id, field, value, updated_at) VALUES (?, ?, ?, ?)", rows)
+            if now - self.last_purge > self.purge_interval:
+                self.db.execute("DELETE FROM session_state WHERE updated_at <= ?", (now - self.ttl,))
+                self.last_purge = now
+            self.db.commit()
+
+    async def get(self, session_id: str) -> dict:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.read, session_id)
+
+    async def update(self, session_id: str, fields: dict):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.write, session_id, fields)
+
+class RedisSessionStore:
+    """Session state in Redis (or anything that speaks its protocol), shared across machines"""
+
+    def __init__(self, url: str, ttl: float = 7*24*60*60):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise ImportError("The redis package is required for a redis:// session store. Please install it with `pip install redis`.")
+        self.redis = redis.from_url(url)
+        self.ttl = int(ttl)
+
+    async def get(self, session_id: str) -> dict:
+        fields = await self.redis.hgetall(f"session:{session_id}")
+        return {field.decode("utf-8"): decode(value) for field, value in fields.items()}
+
+    async def update(self, session_id: str, fields: dict):
+        key = f"session:{session_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={field: encode(value) for field, value in fields.items()})
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+def get_session_store(url: str, ttl: float = 7*24*60*60):
+    """Create a session store from a URL like sqlite:///sessions.db or redis://localhost:6379/0"""
+    if url.startswith("sqlite:///"):
+        return SqliteSessionStore(url[len("sqlite:///"):], ttl=ttl)
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisSessionStore(url, ttl=ttl)
+    raise ValueError(f"Unsupported session store URL: {url}")
@@ -0,0 +1,56 @@
+import time
+import asyncio
+
+#### Coalesced streaming to the browser ####
+# Every stream_token call is a separate websocket emit, so text is sent in frames instead.
+
+class CoalescedStream:
+    """Buffers text for a Chainlit message and sends it as one frame per `interval` seconds, or
+    sooner once `max_chars` have built up. The first text goes out immediately so time to first
+    token is unchanged, and text is never held for longer than `interval`."""
+
+    def __init__(self, msg, interval: float = 0.04, max_chars: int = 256):
+        self.msg = msg
+        self.interval = interval
+        self.max_chars = max_chars
+        self.buffer = ""
+        self.last_flush = None
+        self.timer = None # flushes text that is still waiting when no more arrives
+        self.flushing = None
+        self.lock = asyncio.Lock()
+        self.writes = 0
+        self.frames = 0
+
+    async def write(self, text: str):
+        if not text:
+            return
+        self.writes += 1
+        self.buffer += text
+        if (self.last_flush is None or len(self.buffer) >= self.max_chars
+                or time.monotonic() - self.last_flush >= self.interval):
+            await self.flush()
+        elif self.timer is None:
+            # Only for when no more text arrives: while it keeps coming, the check above sends the
+            # frames, so the timer is counted from this write rather than from the last frame
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self.flush_later)
+
+    def flush_later(self):
+        self.timer = None
+        self.flushing = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        async with self.lock:
+            if self.buffer:
+                text, self.buffer = self.buffer, ""
+                await self.msg.stream_token(text)
+                self.frames += 1
+            self.last_flush = time.monotonic()
+
+    async def close(self):
+        """Send whatever is still buffered. Call this before msg.send()."""
+        await self.flush()
+        if self.flushing is not None:
+            await self.flushing
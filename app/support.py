@@ -0,0 +1,69 @@
+import re
+
+#### Cheap local estimate of how well a response is supported by its context ####
+
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "if", "then", "so", "of", "to", "in", "on", "at", "by",
+    "for", "with", "about", "from", "as", "into", "over", "after", "before", "than", "this", "that",
+    "these", "those", "it", "its", "is", "are", "was", "were", "be", "been", "being", "am", "do",
+    "does", "did", "have", "has", "had", "can", "could", "will", "would", "should", "may", "might",
+    "must", "i", "you", "your", "yours", "we", "our", "they", "their", "them", "he", "she", "his",
+    "her", "him", "me", "my", "not", "no", "yes", "also", "very", "just", "more", "most", "some",
+    "any", "all", "such", "what", "which", "who", "when", "where", "why", "how", "there", "here",
+    "s", "t", "re", "ll", "ve", "d", "m"
+}
+
+# A negated claim reuses the context's words, so it only counts as supported if the context negates the same word
+NEGATIONS = {"not", "no", "never", "cannot", "without", "nor"}
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+LIST_NUMBER = re.compile(r"\b\d{1,2}[.)](?=\s|$)")
+
+def content_words(text: str) -> list[str]:
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower().replace("n't", " not")) if word not in STOPWORDS]
+
+def negated_words(text: str, reach: int = 3) -> set:
+    """The first content word within `reach` words after each negation, e.g. {"proven"} for "has not been proven" """
+    words = re.findall(r"[a-z0-9]+", text.lower().replace("n't", " not"))
+    negated = set()
+    for i, word in enumerate(words):
+        if word in NEGATIONS:
+            following = [w for w in words[i+1:i+1+reach] if w not in STOPWORDS and w not in NEGATIONS]
+            negated.update(following[:1])
+    return negated
+
+def bigrams(words: list[str]) -> set:
+    return set(zip(words, words[1:]))
+
+class SupportScorer:
+    """Scores each sentence of a response by how many of its content words and word pairs also
+    appear in the context. Near-verbatim paraphrases score close to 1; new facts score low.
+    Any number that doesn't appear in the context (a dose, a phone number, an age), or negation
+    of a word the context doesn't negate, scores 0."""
+
+    def __init__(self, context: str):
+        words = content_words(context)
+        self.unigrams = set(words)
+        self.bigrams = bigrams(words)
+        self.negated = negated_words(context)
+
+    def sentence_score(self, sentence: str) -> float:
+        words = content_words(sentence)
+        if not words:
+            return 1.0
+        if any(word.isdigit() and word not in self.unigrams for word in words):
+            return 0.0
+        if not negated_words(sentence) <= self.negated:
+            return 0.0
+        unigram_recall = sum(word in self.unigrams for word in words) / len(words)
+        sentence_bigrams = bigrams(words)
+        if not sentence_bigrams:
+            return unigram_recall
+        bigram_recall = len(sentence_bigrams & self.bigrams) / len(sentence_bigrams)
+        return (unigram_recall + bigram_recall) / 2
+
+    def score(self, text: str) -> float:
+        """Support for the least supported sentence in the text"""
+        text = LIST_NUMBER.sub(" ", text)
+        sentences = [s for s in SENTENCE_END.split(text) if s.strip()]
+        return min((self.sentence_score(s) for s in sentences), default=1.0)
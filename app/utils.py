@@ -1,18 +1,24 @@
 import os
+import re
+import asyncio
 from typing import AsyncGenerator
 from dotenv import load_dotenv
 
-import chainlit as cl
-
 from langchain.schema import Document
 from langchain_core.tools import tool
+from langchain_core.messages import BaseMessage
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain.memory.chat_memory import BaseChatMemory
 
-from zeep import Client
 from zeep.helpers import serialize_object
 
-from vars import FACT_CHECKER_PROMPT, FACT_CHECKER_MESSAGE, FACT_FIXER_PROMPT, FACT_CHECKER_GIVE_UP_MESSAGE
+from eldercare import EldercareClient
+from router import needs_eldercare_lookup, load_gazetteer, CITIES
+from support import SupportScorer
+from scheduler import get_scheduler
+from metrics import span
+from prompts import fact_checker_messages, fact_fixer_messages
+from vars import ELDERCARE_WSDL, ELDERCARE_TOKEN_TTL, ELDERCARE_RESULT_TTL, ELDERCARE_RESULT_CACHE_SIZE
+from vars import ELDERCARE_WSDL_CACHE_FILE, ELDERCARE_WSDL_CACHE_TTL, ELDERCARE_WSDL_TIMEOUT, GAZETTEER_FILE
 
 #### Code to work with the Eldercare API ####
 
@@ -20,40 +26,38 @@ load_dotenv('.env')
 ELDERCARE_API_USERNAME = os.getenv("ELDERCARE_API_USERNAME")
 ELDERCARE_API_PASSWORD = os.getenv("ELDERCARE_API_PASSWORD")
 
-# Initialize the ElderCare API client with the WSDL URL
-wsdl = 'https://eldercare.acl.gov/WebServices/EldercareData/ec_search.asmx?WSDL'
-client = None
-try:
-    client = Client(wsdl=wsdl)
-except Exception as e:
-    print(f"error initializing client: {e}")
+# City names the location pre-router looks for, loaded once per process
+ROUTER_CITIES = CITIES | load_gazetteer(GAZETTEER_FILE)
+
+# The ElderCare API client is created on first use. Creating it doesn't touch the network; the
+# WSDL is loaded in the background by warm_up(), or on the first tool call
+eldercare_client = None
+
+def get_eldercare_client() -> EldercareClient:
+    global eldercare_client
+    if not eldercare_client:
+        eldercare_client = EldercareClient(ELDERCARE_WSDL, ELDERCARE_API_USERNAME, ELDERCARE_API_PASSWORD,
+                                           token_ttl=ELDERCARE_TOKEN_TTL, result_ttl=ELDERCARE_RESULT_TTL, max_results=ELDERCARE_RESULT_CACHE_SIZE,
+                                           wsdl_cache_path=ELDERCARE_WSDL_CACHE_FILE, wsdl_cache_ttl=ELDERCARE_WSDL_CACHE_TTL,
+                                           wsdl_timeout=ELDERCARE_WSDL_TIMEOUT)
+    return eldercare_client
 
 @tool
-def search_by_city_state(city: str, state: str):
+async def search_by_city_state(city: str, state: str):
     """Uses the Eldercare Data API to search for elder care close to a given city and two-letter state abbreviation"""
     result = ""
-    global client
     try:
-        if not client:
-            client = Client(wsdl=wsdl)
-        if client:
-            session_token = client.service.login(ELDERCARE_API_USERNAME, ELDERCARE_API_PASSWORD)
-            result = client.service.SearchByCityState(asCity=city, asState=state, asToken=session_token)
+        result = await get_eldercare_client().search_by_city_state(city, state)
     except Exception as e:
         print(f"error in API call: {e}")
     return result
 
 @tool
-def search_by_zip(zip_code: str):
+async def search_by_zip(zip_code: str):
     """Uses the Eldercare Data API to search for elder care close to a zip code"""
     result = ""
-    global client
     try: 
-        if not client:
-            client = Client(wsdl=wsdl)
-        if client: 
-            session_token = client.service.login(ELDERCARE_API_USERNAME, ELDERCARE_API_PASSWORD)
-            result = client.service.SearchByZip(asZipCode=zip_code, asToken=session_token)
+        result = await get_eldercare_client().search_by_zip(zip_code)
     except Exception as e:
         print(f"error in API call: {e}")
     return result
@@ -97,8 +101,14 @@ async def use_eldercare_api(messages,llm_with_tools):
     ai_msg = None
     tool_output = None
 
+    # Skip the tool-calling LLM entirely when there's no location to search with
+    if not needs_eldercare_lookup(messages, cities=ROUTER_CITIES):
+        print(f"{use_eldercare_api.__name__}: no location found, skipping Eldercare lookup")
+        return tool_call_results
+
     try:
-        ai_msg = await llm_with_tools.ainvoke(messages)
+        with span("tool_routing_llm"):
+            ai_msg = await retry_invoke(llm_with_tools, messages)
     except Exception as e:
         print(f"{use_eldercare_api.__name__}: LLM invocation returned an error: {e}")
 
@@ -107,7 +117,8 @@ async def use_eldercare_api(messages,llm_with_tools):
             selected_tool = {"search_by_city_state": search_by_city_state, "search_by_zip": search_by_zip}[tool_call["name"].lower()]
             try:
                 print(f"selected_tool: {selected_tool}")
-                tool_output = await selected_tool.ainvoke(tool_call["args"])
+                with span("eldercare_api"):
+                    tool_output = await selected_tool.ainvoke(tool_call["args"])
                 tool_call_results += condense_tool_output(tool_output)
 
             except Exception as e:
@@ -117,38 +128,17 @@ async def use_eldercare_api(messages,llm_with_tools):
     return tool_call_results
 
 #### Functions to help fail gracefully if the API is under load ####
+# All calls go through the model's shared scheduler, which limits concurrency and request rate,
+# retries with jittered backoff and stops calling a failing model for a while.
 
-async def retry_stream(llm, prompt: str) -> AsyncGenerator:
-    """Simple retry for streaming LLM calls"""
-    max_attempts = 3
-    delay = 1  # Start with 1 second delay
-    
-    for attempt in range(max_attempts):
-        try:
-            async for chunk in llm.astream(prompt):
-                yield chunk
-            return
-        except Exception as e:
-            if attempt == max_attempts - 1:  # Last attempt failed
-                raise  # Re-raise the last exception
-            print(f"Attempt {attempt + 1} failed, retrying in {delay} seconds...")
-            await asyncio.sleep(delay)
-            delay *= 2  # Double the delay for next attempt
-
-async def retry_invoke(llm, prompt: str):
-    """Simple retry for non-streaming LLM calls"""
-    max_attempts = 3
-    delay = 1  # Start with 1 second delay
-    
-    for attempt in range(max_attempts):
-        try:
-            return await llm.ainvoke(prompt)
-        except Exception as e:
-            if attempt == max_attempts - 1:  # Last attempt failed
-                raise  # Re-raise the last exception
-            print(f"Attempt {attempt + 1} failed, retrying in {delay} seconds...")
-            await asyncio.sleep(delay)
-            delay *= 2  # Double the delay for next attempt
+async def retry_stream(llm, prompt) -> AsyncGenerator:
+    """Streaming LLM call with scheduling and retries"""
+    async for chunk in get_scheduler(llm).stream(llm, prompt):
+        yield chunk
+
+async def retry_invoke(llm, prompt):
+    """Non-streaming LLM call with scheduling and retries"""
+    return await get_scheduler(llm).invoke(llm, prompt)
 
 
 #### Other utilities ####
@@ -176,70 +166,121 @@ def add_sources(context: list[Document]) -> str:
     sources_str = "\n\nSources: " + " ".join(sources)
     return sources_str
 
-# Fact-checking function
-async def check_facts(formatted_context:str, tool_output:str, ai_response:str,
-                      fact_checker_llm:BaseChatModel, memory:BaseChatMemory, fact_fixer_llm:BaseChatModel,
-                      attempt:int=1, max_tries:int=3) -> bool:
-    # Check the factfulness of an LLM response by comparing it against its context. 
-    # If the response is not supported by the context, regenerate it.
-    
-    fact_checker_passed = False
-    fact_checker_prompt_inputs = {
-                    'context': formatted_context,
-                    'tool_output': tool_output,
-                    'ai_response': ai_response # change this line to something irrelevant or untrue to test the fact-checker
+#### Fact checking that runs alongside generation ####
+
+# Places where a streamed response can be split into sentences (or list items)
+SENTENCE_BREAK = re.compile(r"(?<=[.!?:])\s+|\n+")
+
+def split_sentences(buffer: str, min_chars: int = 20) -> tuple[list[str], str]:
+    """Split complete sentences off the front of a buffer. Returns (sentences, leftover text).
+    Very short pieces such as list numbers are merged into the following sentence."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_BREAK.finditer(buffer):
+        if len(buffer[start:match.end()].strip()) >= min_chars:
+            sentences.append(buffer[start:match.end()])
+            start = match.end()
+    return sentences, buffer[start:]
+
+class StreamingFactChecker:
+    """Fact checks a response in batches of sentences while it is still being generated. Each batch
+    is checked against the context concurrently with generation, and only supported (or fixed) text
+    is released, in order, so the user never watches an answer get retracted."""
+
+    def __init__(self, formatted_context: str, tool_output: str, history: str,
+                 fact_checker_llm: BaseChatModel, fact_fixer_llm: BaseChatModel,
+                 batch_size: int = 3, min_sentence_chars: int = 20, skip_threshold: float = 0.65,
+                 enabled: bool = True):
+        self.formatted_context = formatted_context
+        self.tool_output = tool_output
+        self.history = history
+        self.fact_checker_llm = fact_checker_llm
+        self.fact_fixer_llm = fact_fixer_llm
+        self.batch_size = batch_size
+        self.min_sentence_chars = min_sentence_chars
+        self.scorer = SupportScorer(f"{tool_output}\n{formatted_context}")
+        self.skip_threshold = skip_threshold
+        self.enabled = enabled # turned off when degrading under load
+        self.skipped = 0 # batches the local scorer was confident enough to pass without the LLM
+        self.checked = 0 # batches sent to the fact checker
+        self.fixed = 0 # batches that had to be fixed or held back
+        self.failed = 0 # batches passed unchecked because the fact checker LLM failed
+
+    async def check(self, text: str) -> str:
+        """Return the batch unchanged if the context supports it, otherwise a fixed version"""
+        fact_checker_prompt_inputs = {
+                    'context': self.formatted_context,
+                    'tool_output': self.tool_output,
+                    'ai_response': text # change this line to something irrelevant or untrue to test the fact-checker
                     }
 
-    # check whether the response is factual. "Y" indicates a problem, "N" indicates that the 
-    # response is ok
-    fact_checkout_output = None
-    fact_checker_prompt_text = FACT_CHECKER_PROMPT.format(**fact_checker_prompt_inputs)
-    try:
-        fact_checker_output = await retry_invoke(fact_checker_llm, fact_checker_prompt_text)
-    except Exception as e:
-        print(f"Failed to generate fact checking response after multiple retries: {e}")
-
-    if fact_checker_output:
-        print(f"fact checker results: {fact_checker_output.content}")
-                    
-        if 'y' in fact_checker_output.content.lower():
-            # if the checker thinks we gave erroneous info, remove the last message and try again
-            await msg.remove()
-            if attempt == 1: 
-                await cl.Message(content=FACT_CHECKER_MESSAGE).send()
-                print("regenerating response -- attempt 1")
-                        
-            if attempt < max_tries:
-                # Attempt to fix the response without re-doing retrieval 
-                msg = cl.Message(content="")
-                ai_response = ""
-                fact_fixer_prompt_inputs = {
-                    'history': memory.load_memory_variables({})["history"],
-                    'context': formatted_context,
-                    'tool_output': tool_output,
-                    'ai_response': ai_response # change this line to something irrelevant or untrue to test the fact-checker
-                }
-                fact_fixer_prompt_text = FACT_FIXER_PROMPT.format(**fact_fixer_prompt_inputs)
-
-                try: 
-                    async for chunk in retry_stream(fact_fixer_llm, fact_fixer_prompt_text):
-                        #print(chunk) #uncomment to debug streaming
-                        ai_response+=chunk.content
-                        await msg.stream_token(chunk.content)
-
-                    await msg.stream_token(sources)
-                    await msg.send()
-                except Exception as e:
-                    print(f"Failed to fix fact checking response after multiple retries: {e}")
-
-            else:
-                # If max_tries is reached, send a "give up" message to avoid an infinite loop
-                print(f"Failed to generate fixed response after retries: {e}")
-
-                ai_response = FACT_CHECKER_GIVE_UP_MESSAGE
-                await cl.Message(content=ai_response).send()
-                print(f"reached max attempts, generating give-up message")
+        if not self.enabled:
+            return text
 
-        else:
-            fact_checker_passed = True
-    return fact_checker_passed
+        # Text that closely paraphrases the context doesn't need an LLM to confirm it
+        support = self.scorer.score(text)
+        if support >= self.skip_threshold:
+            self.skipped += 1
+            return text
+
+        # "Y" indicates a problem, "N" indicates that the text is ok
+        try:
+            with span("fact_check_llm"):
+                fact_checker_output = await retry_invoke(self.fact_checker_llm, fact_checker_messages(**fact_checker_prompt_inputs))
+        except Exception as e:
+            print(f"Failed to generate fact checking response after multiple retries: {e}")
+            self.failed += 1
+            return text
+        self.checked += 1
+        print(f"fact checker results: {fact_checker_output.content} (local support score {support:.2f})")
+        if 'y' not in fact_checker_output.content.lower():
+            return text
+
+        # Fix just this batch without re-doing retrieval
+        self.fixed += 1
+        fact_fixer_prompt_inputs = {'history': self.history, **fact_checker_prompt_inputs}
+        try:
+            with span("fact_fix_llm"):
+                fact_fixer_output = await retry_invoke(self.fact_fixer_llm, fact_fixer_messages(**fact_fixer_prompt_inputs))
+        except Exception as e:
+            # Hold back unsupported text rather than show it
+            print(f"Failed to fix fact checking response after multiple retries: {e}")
+            return ""
+        trailing_whitespace = text[len(text.rstrip()):]
+        return fact_fixer_output.content.strip() + trailing_whitespace
+
+    async def stream(self, llm: BaseChatModel, prompt: list[BaseMessage]) -> AsyncGenerator:
+        """Stream the LLM's response, yielding text only once it has passed the fact checker"""
+        checks = asyncio.Queue()
+
+        async def generate():
+            try:
+                buffer = ""
+                sentences = []
+                batch_size = 1 # release the first sentence on its own to keep time to first token low
+                async for chunk in retry_stream(llm, prompt):
+                    #print(chunk) #uncomment to debug streaming
+                    buffer += chunk.content
+                    new_sentences, buffer = split_sentences(buffer, self.min_sentence_chars)
+                    sentences += new_sentences
+                    while len(sentences) >= batch_size:
+                        checks.put_nowait(asyncio.create_task(self.check("".join(sentences[:batch_size]))))
+                        sentences = sentences[batch_size:]
+                        batch_size = self.batch_size
+                rest = "".join(sentences) + buffer
+                if rest.strip():
+                    checks.put_nowait(asyncio.create_task(self.check(rest)))
+            finally:
+                checks.put_nowait(None)
+
+        generator = asyncio.create_task(generate())
+        try:
+            while (check := await checks.get()) is not None:
+                yield await check
+            await generator # re-raise any generation error
+            print(f"fact checker: {self.checked} LLM checks, {self.skipped} skipped by local scorer, {self.fixed} fixed, {self.failed} failed")
+        finally:
+            generator.cancel()
+            while not checks.empty():
+                check = checks.get_nowait()
+                if check: check.cancel()
@@ -1,41 +1,100 @@
 COLLECTION_NAME_FIXED = "DementiaCare_Fixed"
 COLLECTION_NAME_SEMANTIC = "DementiaCare_Semantic"
 
-PASSWORD_FILE = "auth.txt" # definitely change this later, this is not secure
+PASSWORD_FILE = "auth.txt" # old CSV credentials file, migrated into PASSWORD_DB on startup
+PASSWORD_DB = "auth.db" # definitely change this later, this is not secure
+
+SESSION_STORE_URL = "sqlite:///sessions.db" # or e.g. redis://localhost:6379/0 to share sessions across machines
+SESSION_TTL = 7*24*60*60 # seconds to keep an idle conversation
 
 URL="http://localhost:6333"
-MAX_CONTEXT = 4
+
+# Retrieved chunks are deduplicated, diversified with MMR and packed into this many tokens
+# (about what the previous limit of 4 fixed-size chunks used)
+CONTEXT_TOKEN_BUDGET = 1500
+CONTEXT_MMR_LAMBDA = 0.7 # 1 ranks by relevance only, lower values favour diversity
+CONTEXT_DUPLICATE_THRESHOLD = 0.8 # share of shingles two chunks must have in common to be merged
+CONTEXT_MMR_VECTORS = True # compare chunks by their stored vectors; False uses shingle overlap and keeps search responses small
+
+LEXICAL_INDEX_FILE = "lexical_index.json.gz" # BM25 index written by notebooks/chunk_and_load_data.ipynb
+EMBEDDING_TIMEOUT = 1.5 # seconds to wait for the query embedding before retrieving from the lexical index alone
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_CACHE_FILE = "embedding_cache.db" # shared with notebooks/chunk_and_load_data.ipynb
+EMBEDDING_CACHE_MEMORY_SIZE = 1000 # max vectors kept in memory
+EMBEDDING_CACHE_DISK_SIZE = 40000 # max vectors kept on disk, about 500MB of full-size (3072-dim float32) vectors
+
+# How the Qdrant collections store vectors. Changing this means re-running chunk_and_load_data.ipynb;
+# test_vector_storage.ipynb compares the memory, search latency and recall of each setting.
+VECTOR_STORAGE = {
+    "dimensions": 3072, # keep the first 256, 512, 1024... dimensions of each embedding (3072 is full size)
+    "quantization": None, # None, "scalar" (int8, 4x smaller) or "binary" (32x smaller, best with 1024+ dimensions)
+    "rescore": True, # re-rank quantized search results with the full-precision vectors
+    "oversampling": 2.0 # candidates fetched per result for rescoring
+}
+
+ELDERCARE_WSDL = "https://eldercare.acl.gov/WebServices/EldercareData/ec_search.asmx?WSDL"
+ELDERCARE_TOKEN_TTL = 15*60 # seconds to re-use an Eldercare API session token before logging in again
+ELDERCARE_RESULT_TTL = 24*60*60 # seconds to cache agency listings for a zip code or city
+ELDERCARE_RESULT_CACHE_SIZE = 1000 # max zip codes and cities with cached listings
+ELDERCARE_WSDL_CACHE_FILE = "eldercare_wsdl_cache.db" # local copy of the WSDL and its XSDs
+ELDERCARE_WSDL_CACHE_TTL = 30*24*60*60
+ELDERCARE_WSDL_TIMEOUT = 10 # seconds to wait on the WSDL site before retrying in the background
+GAZETTEER_FILE = "us_cities.txt" # optional list of city names, one per line, for the location pre-router
+
+ANSWER_CACHE_ENABLED = False # re-use fact-checked answers for near-duplicate questions
+ANSWER_CACHE_THRESHOLD = 0.95 # min cosine similarity between queries for a cache hit
+ANSWER_CACHE_TTL = 24*60*60 # seconds before a cached answer is considered stale
+ANSWER_CACHE_SIZE = 500
+ANSWER_CACHE_MAX_HISTORY = 3 # only use the cache for the first N user turns; those turns are answered without the history
 
 HAIKU = "claude-3-haiku-20240307" # cheaper and better to use for prototyping, although we'll use 3.5 in our app
 SONNET = "claude-3-5-sonnet-20240620"
 TEMPERATURE = 0.1
 TOP_P = 0.9
 MAX_TOKENS = 1000
-MAX_MEMORY = 10
+# Limits for all calls to each model, across every session in one process. With requests_per_second
+# None there is no client-side rate limit, and calls are only paused after the API answers 429.
+# Each worker process has its own limits, so to rate limit up front set requests_per_second (and
+# burst) to the organisation's Anthropic rate limit divided by the number of worker processes.
+MODEL_LIMITS = {
+    SONNET: {"max_concurrency": 16, "requests_per_second": None},
+    HAIKU: {"max_concurrency": 16, "requests_per_second": None}
+}
+LATENCY_SLO = 2.0 # seconds a Sonnet call may wait in the queue before answers degrade to Haiku
+DEGRADE_SKIP_FACT_CHECK = True # also skip the fact check while degraded
+METRICS_ENABLED = True # per-stage latency and token counts, served at /metrics
+STREAM_FLUSH_INTERVAL = 0.04 # seconds between websocket frames while streaming an answer
+STREAM_FLUSH_CHARS = 256 # or send a frame sooner once this much text is waiting
+PROMPT_CACHING = True # mark the static system prompts and the conversation history for Anthropic's prompt cache
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"} # needed by anthropic SDK versions without GA caching
+
+# Max tokens of conversation history sent to each consumer. Older turns are summarized so that the
+# summary and the turns after it fit in the smallest of these
+REWRITER_TOKEN_BUDGET = 1000
+ROUTER_TOKEN_BUDGET = 500
+ANSWER_HISTORY_TOKEN_BUDGET = 2000
+ANSWER_HISTORY_STEP = 4 # drop old messages from the answer history this many at a time, so its start stays cacheable
+
+FACT_CHECK_BATCH_SIZE = 3 # sentences per fact checker call, after the first sentence
+FACT_CHECK_SKIP_THRESHOLD = 0.65 # local support score (lowest sentence in the batch) at or above which the LLM fact checker is skipped
 
 GREETING = """Hi there! I'm CareCompanion, an AI-powered chat system here to support caregivers of dementia patients. Can you please tell me your name and what you'd like to chat about today?"""
 
-SYSTEM_PROMPT = """
+# Each prompt is a static system prompt, which is the same for every call and can be served from
+# Anthropic's prompt cache, followed by templates for the parts that change (see prompts.py)
+ANSWER_SYSTEM_PROMPT = """
 You are CareCompanion, and you specialize in helping informal caregivers of dementia and Alzheimer's patients
 navigate the stresses of everyday life. You are helpful, kind, and a good listener. You can share information 
 about these conditions but you're not a doctor. 
-Use the context in <context></context> below to answer the user's input. 
-
-Here is the conversation history between you and the user. Pay attention to the history and use it in your answer.
-<conversation_history>
-{history}
-</conversation_history>
+Use the context in <context></context> to answer the user's input in <input></input>.
 
-Here is the context to help answer the question.
-<context>
-{context}
-</context>
-
-Here is some information about eldercare resources from the ElderCare API. It may be empty if there is no information.
-If you share eldercare resources, make sure to include contact information and website links. 
-<eldercare_api_output>
-{tool_output}
-</eldercare_api_output>
+Each message from the user contains:
+- The conversation history between you and the user in <conversation_history></conversation_history>. Pay attention to the history and use it in your answer.
+- The context to help answer the question in <context></context>.
+- Information about eldercare resources from the ElderCare API in <eldercare_api_output></eldercare_api_output>. It may be empty if there is no information.
+If you share eldercare resources, make sure to include contact information and website links.
+- The user's input in <input></input>.
 
 Here are important rules:
 <rules>
@@ -52,6 +111,25 @@ Here are important rules:
 - Generate your answer and then stop. Do NOT answer for the human.
 - Only use facts that are in the context.
 </rules>
+"""
+
+# Opens the first history line; each line of history is sent as its own block so that a turn's
+# history is a prefix of the next turn's
+ANSWER_HISTORY_HEADER = """Here is the conversation history between you and the user.
+<conversation_history>
+"""
+
+ANSWER_PROMPT = """</conversation_history>
+
+Here is the context to help answer the question.
+<context>
+{context}
+</context>
+
+Here is some information about eldercare resources from the ElderCare API.
+<eldercare_api_output>
+{tool_output}
+</eldercare_api_output>
 
 Here is the user's input:
 <input>
@@ -59,46 +137,55 @@ Here is the user's input:
 </input>
 """
 
-FACT_CHECKER_MESSAGE = """I apologize, but my response might have contained incorrect or irrelevant information. Please be patient while I double check, so that I can make sure get you the best information possible..."""
+SUMMARY_PROMPT = """
+Progressively summarize the lines of conversation between a caregiver and CareCompanion, 
+adding onto the previous summary and returning a new summary. Keep the caregiver's name, 
+the person they care for, their location, and anything else that helps personalize the conversation.
+Keep the summary under 100 words.
+
+<current_summary>
+{summary}
+</current_summary>
+
+<new_lines>
+{new_lines}
+</new_lines>
+
+New summary: """
+
 FACT_CHECKER_GIVE_UP_MESSAGE = """I'm so sorry, it looks like I can't answer your question accurately. I'm still learning. Do you have other questions I can help with?"""
 
-FACT_CHECKER_PROMPT = """
-Here is some context:
+FACT_CHECKER_SYSTEM_PROMPT = """
+You check statements made by a chatbot against the context the chatbot was given. Each message contains
+the context in <context></context> and a chatbot statement in <chatbot_statement></chatbot_statement>.
+Reply Y if the chatbot statement contains any facts that are NOT supported by the context, and N if it doesn't.
+Reply with the single letter Y or N.
+"""
+
+# Shared by every fact checker and fact fixer call in a turn
+FACT_CHECKER_CONTEXT = """Here is some context:
 <context>
 {tool_output}
 
 {context}
 </context>
+"""
 
+FACT_CHECKER_PROMPT = """
 Here is a chatbot statement:
 <chatbot_statement>
 {ai_response}
-<chatbot_statement>
+</chatbot_statement>
 
 Does the chatbot statement contain any facts that are NOT supported by the context? Reply Y for Yes and N for No.
 Response (Y/N):
 """
 
-FACT_FIXER_PROMPT = """
+FACT_FIXER_SYSTEM_PROMPT = """
 You are CareCompanion and you specialize in helping informal caregivers of dementia and Alzheimer's patients
 navigate the stresses of everyday life. Your job is to check an AI response and make sure
-that it only contains facts from the context.
-
-<chat_history>
-{history}
-</chat_history>
-
-Here is some context:
-<context>
-{tool_output}
-
-{context}
-</context>
-
-Here is an AI response:
-<chatbot_statement>
-{ai_response}
-</chatbot_statement>
+that it only contains facts from the context. Each message contains the context in <context></context>,
+the chat history in <chat_history></chat_history> and an AI response in <chatbot_statement></chatbot_statement>.
 
 Fix the AI response so that it ONLY contains facts that are supported by the context.  Follow these rules:
 <rules>
@@ -109,5 +196,18 @@ Fix the AI response so that it ONLY contains facts that are supported by the con
 - Do not say "According to the context", "according to the information", etc
 - Always stay in character
 </rules>
+"""
+
+FACT_FIXER_PROMPT = """
+<chat_history>
+{history}
+</chat_history>
+
+Here is an AI response:
+<chatbot_statement>
+{ai_response}
+</chatbot_statement>
+
+Fix the AI response so that it ONLY contains facts that are supported by the context.
 
-New paragraph: """
\ No newline at end of file
+New paragraph: """
@@ -0,0 +1,70 @@
+from typing import Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from qdrant_client import models
+
+#### Vector size and quantization for the Qdrant collections ####
+# text-embedding-3 models are trained so that the first dimensions of a vector carry most of its
+# meaning (Matryoshka representation learning), so vectors can be truncated and re-normalized at a
+# small cost in retrieval quality. Quantization shrinks the in-memory index further; the
+# full-precision vectors are kept on disk and used to rescore the top candidates.
+
+class TruncatedEmbeddings(Embeddings):
+    """Keeps the first `dimensions` of each vector and re-normalizes it, which gives the same vectors
+    as OpenAI's `dimensions` parameter. Truncating locally means the embedding cache holds full-size
+    vectors, so changing the setting doesn't need any new embedding calls."""
+
+    def __init__(self, embeddings: Embeddings, dimensions: int):
+        self.embeddings = embeddings
+        self.dimensions = dimensions
+
+    def truncate(self, vectors: list[list[float]]) -> list[list[float]]:
+        matrix = np.array(vectors, dtype=np.float32)[:, :self.dimensions]
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+        return matrix.tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.truncate(self.embeddings.embed_documents(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.truncate([self.embeddings.embed_query(text)])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.truncate(await self.embeddings.aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return self.truncate([await self.embeddings.aembed_query(text)])[0]
+
+def storage_embeddings(embeddings: Embeddings, storage: dict, full_dimensions: int = 3072) -> Embeddings:
+    """The embeddings to store and search with for a VECTOR_STORAGE setting"""
+    dimensions = storage.get("dimensions", full_dimensions)
+    return TruncatedEmbeddings(embeddings, dimensions) if dimensions < full_dimensions else embeddings
+
+def collection_options(storage: dict) -> tuple[dict, dict]:
+    """(vector_params, collection_create_options) for QdrantVectorStore.from_documents"""
+    quantization = storage.get("quantization")
+    if quantization is None:
+        return {}, {}
+    if quantization == "scalar":
+        config = models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True))
+    elif quantization == "binary":
+        config = models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    else:
+        raise ValueError(f"Unsupported quantization: {quantization}")
+    # Only the quantized vectors need to be in memory; the originals are read from disk for rescoring
+    return {"on_disk": True}, {"quantization_config": config}
+
+def search_params(storage: dict) -> Optional[models.SearchParams]:
+    """Search parameters for a quantized collection, or None to use Qdrant's defaults"""
+    if storage.get("quantization") is None:
+        return None
+    return models.SearchParams(quantization=models.QuantizationSearchParams(
+        rescore=storage.get("rescore", True), oversampling=storage.get("oversampling", 2.0)))
+
+def index_bytes(count: int, storage: dict) -> int:
+    """Rough size of the vectors that have to be kept in memory"""
+    dimensions = storage.get("dimensions", 3072)
+    bytes_per_vector = {None: dimensions * 4, "scalar": dimensions, "binary": dimensions // 8}[storage.get("quantization")]
+    return count * bytes_per_vector